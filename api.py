@@ -0,0 +1,119 @@
+"""
+Async API of the localization, to use it from a running event loop with a shared aiohttp.ClientSession:
+
+    async with aiohttp.ClientSession() as session:
+        result = await localize_markdown(text, session)  # in memory
+        async for file_result in localize_files(md_files, session):  # markdown files, as they complete
+            ...
+        await MdImageLocal(md_path).run_async(session)  # a folder, as the command line does
+
+The timeouts and headers (e.g. User-Agent) of the downloads are those of the session.
+"""
+import asyncio
+import io
+import os
+from typing import AsyncIterator, Dict, List, NamedTuple, Optional, Union
+
+import aiohttp
+
+from localize import (COROUTINE_NUM, DownloadContext, MdImageLocal, count_result, create_download_tasks,
+                      fetch_with_retry, find_fail_dict, localize_md_text, open_and_read)
+from utils import write_file
+
+__all__ = ["LocalizedMarkdown", "LocalizedFile", "MdImageLocal", "fetch_image_bytes", "localize_markdown",
+           "localize_files"]
+
+
+class LocalizedMarkdown(NamedTuple):
+    """Result of localize_markdown"""
+    text: str  # the markdown text with the local paths of its images
+    images: Dict[str, Union[bytes, str]]  # local path -> image, or its saved path with an out_folder_path
+    failed: Dict[str, str]  # url -> local path of the images which could not be downloaded
+
+
+class LocalizedFile(NamedTuple):
+    """Result of localize_files for one markdown file"""
+    md_file: str  # the source markdown file
+    out_file: Optional[str]  # the localized markdown file, None if the file has no image url or could not be read
+    images: Dict[str, str]  # url -> local path
+    failed: Dict[str, str]  # url -> local path of the images which could not be downloaded
+
+
+async def fetch_image_bytes(ctx: DownloadContext, img_url: str) -> Optional[bytes]:
+    """Download the image from the link into memory, return None if the download failed"""
+    buffer = io.BytesIO()
+    result = await fetch_with_retry(ctx, img_url, buffer)
+    count_result(ctx, img_url, result)
+    return buffer.getvalue() if result is not None else None
+
+
+async def localize_markdown(text: str, session: aiohttp.ClientSession, name: str = "note.md",
+                            out_folder_path: str = None, coroutine_num: int = COROUTINE_NUM,
+                            regex: str = None, **context_options) -> LocalizedMarkdown:
+    """
+    Localize the markdown text of a file called name: its image urls are replaced by local paths
+    in the name.assets folder, and its images are downloaded through session into memory,
+    or into out_folder_path if given. Nothing is written but the images in out_folder_path.
+    context_options are the extra keyword arguments of DownloadContext, e.g. max_bytes or retries.
+    """
+    new_text, url_dict = localize_md_text(text, name, regex)
+    ctx = DownloadContext(session, coroutine_num, **context_options)
+    if out_folder_path is None:
+        contents = await asyncio.gather(*[fetch_image_bytes(ctx, url) for url in url_dict])
+        images = {local_path: content for local_path, content in zip(url_dict.values(), contents)
+                  if content is not None}
+        failed = {url: local_path for (url, local_path), content in zip(url_dict.items(), contents)
+                  if content is None}
+        return LocalizedMarkdown(new_text, images, failed)
+    if url_dict:
+        os.makedirs(os.path.join(out_folder_path, name[:-3] + ".assets"), exist_ok=True)
+    await asyncio.gather(*create_download_tasks(ctx, url_dict, out_folder_path))
+    failed = find_fail_dict(url_dict, out_folder_path)
+    images = {local_path: os.path.join(out_folder_path, local_path)
+              for url, local_path in url_dict.items() if url not in failed}
+    return LocalizedMarkdown(new_text, images, failed)
+
+
+async def localize_files(md_files: List[str], session: aiohttp.ClientSession, out_folder_path: str = None,
+                         coroutine_num: int = COROUTINE_NUM, regex: str = None,
+                         **context_options) -> AsyncIterator[LocalizedFile]:
+    """
+    Localize the markdown files md_files: write each of them with local image paths into out_folder_path
+    (by default the "out" folder next to it) and download its images there through session.
+    All files share the limits of one DownloadContext, and the result of each file is yielded
+    as soon as all its images are downloaded (or failed).
+    context_options are the extra keyword arguments of DownloadContext, e.g. max_bytes or retries.
+    """
+    ctx = DownloadContext(session, coroutine_num, **context_options)
+
+    loop = asyncio.get_event_loop()
+
+    def rewrite_file(md_file: str, file_out_path: str) -> Dict[str, str]:
+        """Read md_file and write it with local image paths, return its image urls (empty if none or unreadable)"""
+        filename = os.path.basename(md_file)
+        text = open_and_read(md_file)
+        if text is None:
+            return {}
+        new_text, url_dict = localize_md_text(text, filename, regex)
+        if url_dict:
+            os.makedirs(os.path.join(file_out_path, filename[:-3] + ".assets"), exist_ok=True)
+            write_file(file_out_path, filename, new_text)
+        return url_dict
+
+    async def localize_file(md_file: str) -> LocalizedFile:
+        file_out_path = out_folder_path or os.path.join(os.path.dirname(md_file), "out")
+        # the file is read, parsed and written in a thread, so that the event loop is not blocked
+        url_dict = await loop.run_in_executor(None, rewrite_file, md_file, file_out_path)
+        if not url_dict:
+            return LocalizedFile(md_file, None, {}, {})
+        await asyncio.gather(*create_download_tasks(ctx, url_dict, file_out_path))
+        return LocalizedFile(md_file, os.path.join(file_out_path, os.path.basename(md_file)), url_dict,
+                             await loop.run_in_executor(None, find_fail_dict, url_dict, file_out_path))
+
+    tasks = [asyncio.ensure_future(localize_file(md_file)) for md_file in md_files]
+    try:
+        for task in asyncio.as_completed(tasks):
+            yield await task
+    finally:
+        for task in tasks:
+            task.cancel()
@@ -0,0 +1,487 @@
+"""
+Benchmarks of localize.py, on generated markdown files.
+Run `python benchmark.py` and compare the printed timings between versions.
+
+`python benchmark.py --stream` compares reading a large markdown export with embedded data uri images at once
+and streaming it.
+
+`python benchmark.py --shards N` localizes a generated vault with the sharded mode: --plan, then N processes
+running --shard k/N at the same time against the local image server, then --merge.
+
+`python benchmark.py --vault` runs the whole md_recursion pipeline offline, on a generated vault whose images
+are served by a local stand-in image server with configurable latency, bandwidth, errors and sizes,
+and prints the results as JSON (or writes them to --json_out) so that they can be compared between versions.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from aiohttp import web
+
+import localize
+from localize import REGEX_PATTERN, MdImageLocal, create_url2local_dict, file_replace_url, find_url_spans
+
+# Inputs which make a backtracking regex work hard, as functions of a size
+ADVERSARIAL_INPUTS = {
+    "open_brackets": lambda n: "![" * n,
+    "nested_brackets": lambda n: "![" + "[" * n + "](http://x/a.png",
+    "unclosed_links": lambda n: "![a](https://img.example.com/" * (n // 30),
+    "unbalanced_html": lambda n: '<img src="http://x/' + "<div>" * (n // 5),
+    "unclosed_img_tags": lambda n: "<img " * (n // 5),
+    "alts_sharing_a_destination": lambda n: ("![a" * 100 + "](" + "a" * 1000 + "\n") * (n // 1300),
+    "base64_blob": lambda n: "![a](data:image/png;base64," + "QUJD" * (n // 4) + ")",
+    "long_alt": lambda n: "![" + "a " * (n // 2) + "](https://x/a.png)",
+}
+
+
+def generate_markdown(num_links: int, num_urls: int = None) -> str:
+    """
+    Generate a markdown file with num_links image links to num_urls different urls, mixing markdown and <img> links,
+    with some urls being a prefix of others
+    """
+    num_urls = num_urls if num_urls else num_links
+    lines = []
+    for i in range(num_links):
+        url_id = random.randrange(num_urls)
+        lines.append(f"Paragraph {i} with some text to be kept as it is, and an image:")
+        if i % 4 == 0:
+            lines.append(f'<img src="https://img.example.com/post/{url_id}.png" width="600">')
+        else:
+            lines.append(f"![image {i}](https://img.example.com/post/{url_id}.png)")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def replace_url_baseline(file_data: str, url_dict: Dict[str, str]) -> str:
+    """The previous file_replace_url: one str.replace pass per url"""
+    for key, value in url_dict.items():
+        file_data = file_data.replace(key, value)
+    return file_data
+
+
+def bench_rewrite(num_links: int = 5000) -> Dict[str, float]:
+    """Time the rewriting of a generated markdown file with num_links image links"""
+    file_data = generate_markdown(num_links)
+    url_spans = find_url_spans(REGEX_PATTERN, file_data)
+    url_dict = create_url2local_dict(REGEX_PATTERN, file_data, "bench.md", url_spans)
+
+    time0 = time.perf_counter()
+    replace_url_baseline(file_data, url_dict)
+    time1 = time.perf_counter()
+    file_replace_url(file_data, url_dict, "bench.md", url_spans)
+    time2 = time.perf_counter()
+    file_replace_url(file_data, url_dict, "bench.md")
+    time3 = time.perf_counter()
+    return {
+        "links": num_links,
+        "urls": len(url_dict),
+        "bytes": len(file_data),
+        "str_replace_per_url_s": time1 - time0,
+        "single_pass_spans_s": time2 - time1,
+        "single_pass_automaton_s": time3 - time2,
+    }
+
+
+def time_it(func: Callable, *func_args) -> float:
+    time0 = time.perf_counter()
+    func(*func_args)
+    return time.perf_counter() - time0
+
+
+def bench_scan(sizes: List[int] = (2000, 4000, 8000, 16000), regex_limit: float = 10.0) -> List[Dict]:
+    """
+    Time the link extraction of the regexes and of the scanner on adversarial inputs of growing sizes.
+    The time of the scanner should grow linearly with the size. The regexes are not run any more on an input
+    once they took more than regex_limit seconds.
+    """
+    results = []
+    for name, make_input in ADVERSARIAL_INPUTS.items():
+        regex_time = 0.0
+        for size in sizes:
+            file_data = make_input(size)
+            result = {"input": name, "bytes": len(file_data),
+                      "scanner_s": time_it(find_url_spans, None, file_data)}
+            if regex_time <= regex_limit:
+                regex_time = time_it(find_url_spans, REGEX_PATTERN, file_data)
+                result["regex_s"] = regex_time
+            results.append(result)
+    return results
+
+
+def generate_export(path: str, size_mb: int, image_kb: int = 100) -> int:
+    """
+    Write a markdown export of about size_mb MB to path, as note apps do: paragraphs with image links
+    and images of image_kb KiB embedded as base64 data uris. Return the number of embedded images.
+    """
+    images = 0
+    with open(path, "w", encoding="utf-8") as f:
+        while f.tell() < size_mb * 1024 * 1024:
+            f.write(f"Paragraph {images} with a linked image ![linked](https://img.example.com/{images}.png)\n\n")
+            f.write(f"![embedded {images}](data:image/png;base64,"
+                    f"{base64.b64encode(os.urandom(image_kb * 1024)).decode()})\n\n")
+            images += 1
+    return images
+
+
+def bench_stream(size_mb: int = 50, image_kb: int = 100) -> List[Dict]:
+    """
+    Localize a generated export of about size_mb MB with its embedded images extracted, once read at once
+    and once streamed, and return the time and the peak of the memory allocated by Python of both
+    """
+    results = []
+    root = tempfile.mkdtemp(prefix="md_export_")
+    try:
+        images = generate_export(os.path.join(root, "export.md"), size_mb, image_kb)
+        threshold = localize.STREAM_THRESHOLD
+        for mode, stream_threshold in (("read_at_once", float("inf")), ("streamed", 0)):
+            out_path = os.path.join(root, mode)
+            os.mkdir(out_path)
+            localize.STREAM_THRESHOLD = stream_threshold
+            tracemalloc.start()
+            try:
+                time0 = time.perf_counter()
+                url_dict = localize.localize_md_file(root, out_path, "export.md", None, extract_data_uris=True)
+                run_time = time.perf_counter() - time0
+                peak = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+                localize.STREAM_THRESHOLD = threshold
+            results.append({"mode": mode, "mb": os.path.getsize(os.path.join(root, "export.md")) / 1024 / 1024,
+                            "embedded": images, "extracted": len(os.listdir(os.path.join(out_path, "export.assets"))),
+                            "urls": len(url_dict),
+                            "out_kb": os.path.getsize(os.path.join(out_path, "export.md")) / 1024,
+                            "run_s": run_time, "peak_mb": peak / 1024 / 1024})
+    finally:
+        shutil.rmtree(root, ignore_errors=True)
+    return results
+
+
+class ImageServer:
+    """
+    Local stand-in image server, run in its own thread and event loop.
+    GET /img/{name} returns an image whose size is drawn from [min_size, max_size] by the hash of its name,
+    after latency seconds, at bandwidth bytes/s (0: unlimited). A share error_rate of the requests is answered
+    by a 503 and a share rate_429 by a 429, both with "Retry-After: 0". If max_in_flight is set, the requests
+    coming while max_in_flight images are being served are answered by a 429 too, like a rate-limited CDN.
+    The time spent on each served image is recorded in latencies.
+    """
+
+    def __init__(self, latency: float = 0.0, bandwidth: int = 0, error_rate: float = 0.0, rate_429: float = 0.0,
+                 min_size: int = 10 * 1024, max_size: int = 200 * 1024, max_in_flight: int = 0,
+                 seed: int = 0) -> None:
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.rate_429 = rate_429
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_in_flight = max_in_flight
+        self.in_flight = 0
+        self.random = random.Random(seed)
+        self.stats = {"requests": 0, "images": 0, "bytes": 0, "errors": 0, "429": 0}
+        self.latencies = []  # seconds spent on each served image
+        self.port = None
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.runner = None
+
+    def image_size(self, name: str) -> int:
+        digest = int(hashlib.md5(name.encode()).hexdigest(), 16)
+        return self.min_size + digest % (self.max_size - self.min_size + 1)
+
+    async def handle_image(self, request: web.Request) -> web.StreamResponse:
+        time0 = time.perf_counter()
+        self.stats["requests"] += 1
+        draw = self.random.random()
+        if draw < self.error_rate:
+            self.stats["errors"] += 1
+            return web.Response(status=503, headers={"Retry-After": "0"})
+        if draw < self.error_rate + self.rate_429 or 0 < self.max_in_flight <= self.in_flight:
+            self.stats["429"] += 1
+            return web.Response(status=429, headers={"Retry-After": "0"})
+        self.in_flight += 1
+        try:
+            return await self.send_image(request, time0)
+        finally:
+            self.in_flight -= 1
+
+    async def send_image(self, request: web.Request, time0: float) -> web.StreamResponse:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        size = self.image_size(request.match_info["name"])
+        response = web.StreamResponse(headers={"Content-Type": "image/png"})
+        response.content_length = size
+        await response.prepare(request)
+        chunk = bytes(64 * 1024)
+        sent = 0
+        while sent < size:
+            part = chunk[:min(len(chunk), size - sent)]
+            await response.write(part)
+            sent += len(part)
+            if self.bandwidth:
+                await asyncio.sleep(len(part) / self.bandwidth)
+        await response.write_eof()
+        self.stats["images"] += 1
+        self.stats["bytes"] += size
+        self.latencies.append(time.perf_counter() - time0)
+        return response
+
+    async def start_site(self) -> int:
+        app = web.Application()
+        app.router.add_get("/img/{name}", self.handle_image)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        return self.runner.addresses[0][1]
+
+    def start(self) -> str:
+        """Start the server, return its base url"""
+        self.thread.start()
+        self.port = asyncio.run_coroutine_threadsafe(self.start_site(), self.loop).result()
+        return f"http://127.0.0.1:{self.port}"
+
+    def stop(self) -> None:
+        asyncio.run_coroutine_threadsafe(self.runner.cleanup(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+def generate_vault(root: str, base_url: str, folders: int = 20, files_per_folder: int = 10,
+                   links_per_file: int = 20, num_urls: int = 1000, depth: int = 3) -> int:
+    """
+    Generate a vault of folders (nested up to depth levels) of markdown files, whose image links are drawn
+    from num_urls urls shared by all files. Return the number of image links.
+    """
+    for folder in range(folders):
+        folder_path = os.path.join(root, *[f"d{folder}_{level}" for level in range(folder % depth + 1)])
+        os.makedirs(folder_path, exist_ok=True)
+        for file in range(files_per_folder):
+            lines = [f"# Note {folder}-{file}", ""]
+            for link in range(links_per_file):
+                url = f"{base_url}/img/{random.randrange(num_urls)}.png"
+                lines.append(f"Paragraph {link} with some text, and an image:")
+                lines.append(f'<img src="{url}" width="600">' if link % 4 == 0 else f"![image {link}]({url})")
+                lines.append("")
+            with open(os.path.join(folder_path, f"note{file}.md"), "w", encoding="utf-8") as f:
+                f.write("\n".join(lines))
+    return folders * files_per_folder * links_per_file
+
+
+class TimedMdImageLocal(MdImageLocal):
+    """MdImageLocal adding the time spent collecting the url dicts (parsing and rewriting) to parse_time"""
+    parse_time = 0.0
+
+    def collect_img_dict(self):
+        time0 = time.perf_counter()
+        try:
+            return super().collect_img_dict()
+        finally:
+            TimedMdImageLocal.parse_time += time.perf_counter() - time0
+
+    async def collect_img_dict_pipelined(self, pool, url_queue):
+        time0 = time.perf_counter()
+        try:
+            return await super().collect_img_dict_pipelined(pool, url_queue)
+        finally:
+            TimedMdImageLocal.parse_time += time.perf_counter() - time0
+
+
+def percentile(values: List[float], share: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(share * len(values)))]
+
+
+def bench_vault(server_options: Dict = None, vault_options: Dict = None, coroutine_num: int = 8,
+                workers: int = 0, dedup: bool = False, download_options: Dict = None) -> Dict:
+    """
+    Localize a generated vault, folder by folder as md_recursion does, with images served by an ImageServer.
+    Return the throughput, the per-image latency percentiles (as measured by the server), the peak RSS,
+    and the time spent parsing vs the whole time.
+    With workers, parsing overlaps downloading, so download_s is not computed.
+    """
+    server = ImageServer(**(server_options or {}))
+    base_url = server.start()
+    root = tempfile.mkdtemp(prefix="md_vault_")
+    try:
+        links = generate_vault(root, base_url, **(vault_options or {}))
+        localize.COROUTINE_NUM = coroutine_num
+        TimedMdImageLocal.parse_time = 0.0
+        time0 = time.perf_counter()
+        for cur_path, dirs, _ in os.walk(root, topdown=False):
+            if os.path.basename(cur_path) == "out" or cur_path.endswith(".assets"):
+                continue
+            TimedMdImageLocal(md_path=cur_path, dedup=dedup, download_options=download_options,
+                              workers=workers).run()
+        run_time = time.perf_counter() - time0
+    finally:
+        server.stop()
+        shutil.rmtree(root, ignore_errors=True)
+    stats = server.stats
+    # ru_maxrss is in KiB on Linux
+    peak_rss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                   resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return {
+        "links": links,
+        "coroutine_num": coroutine_num,
+        "workers": workers,
+        "server": server_options or {},
+        "vault": vault_options or {},
+        "requests": stats["requests"],
+        "images": stats["images"],
+        "bytes": stats["bytes"],
+        "errors_503": stats["errors"],
+        "errors_429": stats["429"],
+        "run_s": run_time,
+        "parse_s": TimedMdImageLocal.parse_time,
+        "download_s": None if workers else run_time - TimedMdImageLocal.parse_time,
+        "images_per_s": stats["images"] / run_time,
+        "mb_per_s": stats["bytes"] / run_time / 1024 / 1024,
+        "latency_p50_s": percentile(server.latencies, 0.5),
+        "latency_p99_s": percentile(server.latencies, 0.99),
+        "peak_rss_mb": peak_rss / 1024,
+    }
+
+
+def bench_shards(shards: int = 4, server_options: Dict = None, vault_options: Dict = None,
+                 coroutine_num: int = 8, dedup: bool = False) -> Dict:
+    """
+    Localize a generated vault with the sharded mode of localize.py, each shard in its own process, with images
+    served by an ImageServer. Return the time of every step, and the requests of the server: with dedup,
+    every url should be requested once, by the process of its shard.
+    """
+    server = ImageServer(**(server_options or {}))
+    base_url = server.start()
+    root = tempfile.mkdtemp(prefix="md_vault_")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "localize.py")
+
+    def run_localize(*options: str) -> subprocess.Popen:
+        return subprocess.Popen([sys.executable, script, "--md_path", root, "--manifest",
+                                 "--coroutine_num", str(coroutine_num), *options],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    try:
+        links = generate_vault(root, base_url, **(vault_options or {}))
+        time0 = time.perf_counter()
+        run_localize("--plan", "--shards", str(shards)).wait()
+        time1 = time.perf_counter()
+        processes = [run_localize("--shard", f"{k}/{shards}", *(["--dedup"] if dedup else []))
+                     for k in range(1, shards + 1)]
+        for process in processes:
+            process.wait()
+        time2 = time.perf_counter()
+        run_localize("--merge").wait()
+        time3 = time.perf_counter()
+        with open(os.path.join(root, "out", ".plan", "failed.json"), "r", encoding="utf-8") as f:
+            failed = len(json.load(f))
+        urls = set()
+        for cur_path, _, files in os.walk(root):
+            for filename in files:
+                if filename.endswith(".md") and os.path.basename(cur_path) != "out":
+                    with open(os.path.join(cur_path, filename), "r", encoding="utf-8") as f:
+                        urls.update(url_span[2] for url_span in find_url_spans(None, f.read()))
+    finally:
+        server.stop()
+        shutil.rmtree(root, ignore_errors=True)
+    return {
+        "links": links,
+        "urls": len(urls),
+        "shards": shards,
+        "requests": server.stats["requests"],
+        "images": server.stats["images"],
+        "failed": failed,
+        "plan_s": time1 - time0,
+        "execute_s": time2 - time1,
+        "merge_s": time3 - time2,
+        "images_per_s": server.stats["images"] / (time2 - time1),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--links', type=int, default=5000,
+                        help="number of image links in the generated markdown file")
+    parser.add_argument('--scan', action='store_true',
+                        help="benchmark the link extraction on adversarial inputs instead of the rewriting")
+    parser.add_argument('--stream', action='store_true',
+                        help="benchmark reading a large markdown export with embedded images at once vs streaming it")
+    parser.add_argument('--stream_mb', type=int, default=50, help="size of the markdown export of --stream (MB)")
+    parser.add_argument('--vault', action='store_true',
+                        help="benchmark the whole pipeline on a generated vault and a local image server")
+    parser.add_argument('--shards', type=int,
+                        help="benchmark the sharded mode on a generated vault, with this many shard processes")
+    parser.add_argument('--json_out', help="file to write the JSON results of --vault to, instead of printing them")
+    vault_args = parser.add_argument_group("--vault options")
+    vault_args.add_argument('--folders', type=int, default=20)
+    vault_args.add_argument('--files_per_folder', type=int, default=10)
+    vault_args.add_argument('--links_per_file', type=int, default=20)
+    vault_args.add_argument('--num_urls', type=int, default=1000, help="number of different urls in the vault")
+    vault_args.add_argument('--latency', type=float, default=0.02, help="server latency of an image (s)")
+    vault_args.add_argument('--bandwidth_kb', type=int, default=0,
+                            help="server bandwidth of a response (KiB/s, 0: unlimited)")
+    vault_args.add_argument('--error_rate', type=float, default=0.0, help="share of the requests answered by 503")
+    vault_args.add_argument('--rate_429', type=float, default=0.0, help="share of the requests answered by 429")
+    vault_args.add_argument('--min_kb', type=int, default=10, help="min image size (KiB)")
+    vault_args.add_argument('--max_kb', type=int, default=200, help="max image size (KiB)")
+    vault_args.add_argument('--max_in_flight', type=int, default=0,
+                            help="answer 429 while the server sends this many images (0: no limit)")
+    vault_args.add_argument('--coroutine_num', type=int, default=8)
+    vault_args.add_argument('--adaptive', action='store_true', help="tune the concurrency of the downloads")
+    vault_args.add_argument('--workers', type=int, default=0)
+    vault_args.add_argument('--dedup', action='store_true')
+    args = parser.parse_args()
+    if args.vault:
+        logging.basicConfig(level=logging.ERROR)
+        random.seed(0)
+        result = bench_vault(
+            server_options={"latency": args.latency, "bandwidth": args.bandwidth_kb * 1024,
+                            "error_rate": args.error_rate, "rate_429": args.rate_429,
+                            "min_size": args.min_kb * 1024, "max_size": args.max_kb * 1024,
+                            "max_in_flight": args.max_in_flight},
+            vault_options={"folders": args.folders, "files_per_folder": args.files_per_folder,
+                           "links_per_file": args.links_per_file, "num_urls": args.num_urls},
+            coroutine_num=args.coroutine_num, workers=args.workers, dedup=args.dedup,
+            download_options={"retries": 5, "connect_timeout": 5, "read_timeout": 30, "adaptive": args.adaptive})
+        if args.json_out:
+            with open(args.json_out, "w", encoding="utf-8") as f:
+                json.dump(result, f, indent=2)
+        else:
+            print(json.dumps(result, indent=2))
+    elif args.shards:
+        random.seed(0)
+        print(json.dumps(bench_shards(
+            args.shards,
+            server_options={"latency": args.latency, "bandwidth": args.bandwidth_kb * 1024,
+                            "error_rate": args.error_rate, "min_size": args.min_kb * 1024,
+                            "max_size": args.max_kb * 1024},
+            vault_options={"folders": args.folders, "files_per_folder": args.files_per_folder,
+                           "links_per_file": args.links_per_file, "num_urls": args.num_urls},
+            coroutine_num=args.coroutine_num, dedup=args.dedup), indent=2))
+    elif args.stream:
+        logging.basicConfig(level=logging.ERROR)
+        for result in bench_stream(args.stream_mb):
+            print(", ".join(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}"
+                            for key, value in result.items()))
+    elif args.scan:
+        for result in bench_scan():
+            print(", ".join(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}"
+                            for key, value in result.items()))
+    else:
+        for key, value in bench_rewrite(args.links).items():
+            print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
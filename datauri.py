@@ -0,0 +1,103 @@
+# datauri.py
+import binascii
+import hashlib
+import os
+import re
+import uuid
+from typing import Match, Optional, Tuple
+
+from scanner import MAX_ALT_LENGTH, TRIGGER_REGEX, TextFinder
+
+# the data uri of an image embedded in base64, up to the start of its payload: data:image/png;base64,
+DATA_URI = r"""(?P<uri>data:image/(?P<type>[a-z0-9.+-]{1,32})(?:;[^;,\s"')]{0,64}){0,4}?;base64,)"""
+# ![alt](data:image/png;base64,  from the end of the alt text
+LINK_DATA_URI_REGEX = re.compile(r"\]\([ \t]*<?" + DATA_URI, re.IGNORECASE)
+# <img src="data:image/png;base64,  from the quote of the src attribute
+SRC_DATA_URI_REGEX = re.compile(r"""["']""" + DATA_URI, re.IGNORECASE)
+BASE64_REGEX = re.compile(r"[A-Za-z0-9+/=]*")  # the payload, up to the end of the link or attribute
+# image/<type> -> extension, for the types whose extension is not the type itself
+EXTENSIONS = {"jpeg": ".jpg", "pjpeg": ".jpg", "svg+xml": ".svg", "x-icon": ".ico", "vnd.microsoft.icon": ".ico",
+              "x-ms-bmp": ".bmp"}
+
+
+def find_data_uri(finder: TextFinder, pos: int) -> Optional[Tuple[int, Match]]:
+    """
+    Find the first image embedded in base64 in a link or an <img> tag of finder.text after pos, and return
+    the start of the link or tag and the match of its data uri (groups uri and type), or None if there is none.
+    As in scan_image_links, the text is searched once for the links and tags, and the work done for each is bounded.
+    """
+    text = finder.text
+    for trigger in TRIGGER_REGEX.finditer(text, pos):
+        if text[trigger.start()] == "<":
+            m = finder.img_src(trigger.start(), SRC_DATA_URI_REGEX)
+        else:
+            # the alt text goes up to the first "]" of the line, within MAX_ALT_LENGTH characters
+            alt_end = finder.find("]", trigger.end())
+            line_end = finder.find("\n", trigger.end())
+            if alt_end == -1 or alt_end - trigger.end() > MAX_ALT_LENGTH or -1 < line_end < alt_end:
+                continue
+            m = finder.match(LINK_DATA_URI_REGEX, alt_end)
+        if m is not None:
+            return trigger.start(), m
+    return None
+
+
+def image_extension(image_type: str) -> str:
+    """The file extension of an image of the MIME type image/image_type"""
+    image_type = image_type.lower()
+    return EXTENSIONS.get(image_type, "." + re.sub(r"[^a-z0-9]", "", image_type)[:8])
+
+
+class EmbeddedImage:
+    """
+    An image embedded in base64 in a data uri, decoded into a file of folder as its payload is fed piece by piece,
+    so that it is never held in memory as a whole. The file is named after the hash of the image,
+    so that an image embedded several times is saved once.
+    """
+
+    def __init__(self, folder: str, image_type: str) -> None:
+        self.folder = folder
+        self.ext = image_extension(image_type)
+        os.makedirs(folder, exist_ok=True)
+        self.tmp_path = os.path.join(folder, f".{uuid.uuid4().hex}.tmp")
+        self.file = open(self.tmp_path, "wb")
+        self.hash = hashlib.sha256()
+        self.size = 0
+        self.pending = ""  # the last characters of the payload, less than 4, decoded with the next piece
+
+    def write(self, data: bytes) -> None:
+        self.hash.update(data)
+        self.file.write(data)
+        self.size += len(data)
+
+    def feed(self, payload: str) -> None:
+        # the padding is dropped and added back at the end, so that every group of 4 characters decodes alone
+        payload = self.pending + payload.replace("=", "")
+        end = len(payload) - len(payload) % 4
+        self.pending = payload[end:]
+        if end:
+            self.write(binascii.a2b_base64(payload[:end]))
+
+    def close(self) -> Optional[str]:
+        """Decode the rest of the payload and save the image, return its file name, or None if it is empty"""
+        try:
+            # a single character left can not be decoded, it is dropped
+            if len(self.pending) > 1:
+                self.write(binascii.a2b_base64(self.pending + "=" * (-len(self.pending) % 4)))
+        finally:
+            self.file.close()
+        if not self.size:
+            os.remove(self.tmp_path)
+            return None
+        name = self.hash.hexdigest()[:16] + self.ext
+        path = os.path.join(self.folder, name)
+        if os.path.exists(path):
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, path)
+        return name
+
+    def abort(self) -> None:
+        self.file.close()
+        if os.path.exists(self.tmp_path):
+            os.remove(self.tmp_path)
@@ -0,0 +1,88 @@
+# limiter.py
+import asyncio
+import collections
+import logging
+
+LATENCY_TOLERANCE = 2.0  # responses slower than this times the base latency (plus LATENCY_SLACK) stop the increase
+LATENCY_SLACK = 0.05  # seconds
+BASE_LATENCY_DRIFT = 1.001  # the base latency may grow by this factor per response, to follow a slower host
+SMOOTHING = 0.125  # weight of a new latency in the smoothed latency
+DECREASE_FACTOR = 0.5
+
+
+class AdaptiveLimiter:
+    """
+    Limit of the concurrent downloads from one host, tuned AIMD-style from the responses:
+    the limit grows by one for every response in slow start (doubling every round trip) until the first sign
+    of congestion, then by one per round trip (1 / limit per response), as long as the responses are not much
+    slower than the fastest ones; it is halved on a 429/5xx response or a connection error, at most once per
+    smoothed latency so that the requests started before a decrease do not decrease it again.
+    The limit stays between min_limit and max_limit. Use it as an async context manager, like a semaphore.
+    """
+
+    def __init__(self, host: str, initial: int, max_limit: int, min_limit: int = 1) -> None:
+        self.host = host
+        self.min_limit = min_limit
+        self.max_limit = max(max_limit, min_limit)
+        self.limit = float(min(max(initial, min_limit), self.max_limit))
+        self.max_reached = self.limit
+        self.in_flight = 0
+        self.waiters = collections.deque()
+        self.slow_start = True
+        self.base_latency = None  # (nearly) the lowest latency seen
+        self.smoothed_latency = None
+        self.last_decrease = None
+
+    async def __aenter__(self) -> None:
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            return
+        waiter = asyncio.get_event_loop().create_future()
+        self.waiters.append(waiter)
+        try:
+            await waiter  # in_flight is incremented by wake_up
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self.wake_up()
+
+    def wake_up(self) -> None:
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+    def on_success(self, latency: float) -> None:
+        """Tune the limit after a successful response which took latency seconds to come"""
+        if self.base_latency is None:
+            self.base_latency = self.smoothed_latency = latency
+        self.base_latency = min(latency, self.base_latency * BASE_LATENCY_DRIFT)
+        self.smoothed_latency += SMOOTHING * (latency - self.smoothed_latency)
+        if latency > LATENCY_TOLERANCE * self.base_latency + LATENCY_SLACK:
+            self.slow_start = False
+            return
+        old_limit = int(self.limit)
+        self.limit = min(self.max_limit, self.limit + (1 if self.slow_start else 1 / self.limit))
+        self.max_reached = max(self.max_reached, self.limit)
+        if int(self.limit) != old_limit:
+            logging.info(f"Concurrency limit of {self.host} increased to {int(self.limit)}")
+            self.wake_up()
+
+    def on_congestion(self, now: float) -> None:
+        """Tune the limit after a 429/5xx response or a connection error, now is the time of the event loop"""
+        self.slow_start = False
+        if self.last_decrease is not None and now - self.last_decrease < (self.smoothed_latency or 0):
+            return
+        self.last_decrease = now
+        old_limit = int(self.limit)
+        self.limit = max(self.min_limit, self.limit * DECREASE_FACTOR)
+        if int(self.limit) != old_limit:
+            logging.info(f"Concurrency limit of {self.host} decreased to {int(self.limit)}")
@@ -10,89 +10,587 @@ WORKFLOW:
 """
 import argparse
 import asyncio
+import base64
+import datetime
+import email.utils
+import hashlib
+import io
 import sys
 import logging
 import os
 import random
 import re
 import string
+import tempfile
 import time
 import json
 import aiohttp
-import urllib.request
-from typing import Dict
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, List, Optional, TextIO, Tuple, Union
 
-from utils import create_folder, is_valid_url, write_file, count_test_cases, delete_folder
+from datauri import BASE64_REGEX, EmbeddedImage, find_data_uri
+from limiter import AdaptiveLimiter
+from manifest import Manifest, MANIFEST_NAME
+from metrics import Metrics
+from optimize import PILLOW_AVAILABLE, converted_name, optimize_image
+from scanner import MAX_LINK_LENGTH, TextFinder, scan_image_links
+from shard import (PLAN_FOLDER_NAME, PLAN_NAME, ShardCache, parse_shard, read_json, result_path, shard_path,
+                   write_json, write_plan)
+from store import AssetStore, STORE_FOLDER_NAME
+from utils import create_folder, write_file, count_test_cases, delete_folder
+from watch import DEBOUNCE, POLL_INTERVAL, ChangeWatcher, is_source_folder
 
 
 REGEX_PATTERN = r"(?:!\[.*?\])(?:\(|\[)(?P<url>(?:https?\:(?:\/\/)?)(?:\w|\-|\_|\.|\?|\/)+?\/(?P<end>(?:(?=_png\/|_jpg\/|_jpeg\/|_gif\/|_bmp\/|_svg\/)[^\/]+?[^()]+)|(?:[^\/()]+(?:\.png|\.jpg|\.jpeg|\.gif|\.bmp|\.svg)?)))(?:\)|\])"
 COROUTINE_NUM = 2
+MAX_COROUTINE_NUM = 64  # global ceiling of the concurrent downloads in adaptive mode
+CHUNK_SIZE = 64 * 1024  # bytes read from a response at a time
+MAX_IMAGE_BYTES = 100 * 1024 * 1024  # images larger than this are not downloaded
+MEMORY_BUDGET = 16 * 1024 * 1024  # bytes of image chunks held in memory over all downloads
+NOT_MODIFIED = "not-modified"  # result of a conditional download of an unchanged image
+PART_SUFFIX = ".part"  # an image is downloaded to its path + PART_SUFFIX, and renamed once complete
+RETRIES = 3  # retries of a download after a transient failure
+BACKOFF_BASE = 0.5  # seconds, the backoff before the n-th retry is at most BACKOFF_BASE * 2 ** n
+MAX_BACKOFF = 30  # seconds
+MAX_RETRY_AFTER = 120  # seconds, longer Retry-After are not waited for in full
+CONNECT_TIMEOUT = 10  # seconds
+READ_TIMEOUT = 30  # seconds without receiving any data
+USER_AGENT = "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:40.0) Gecko/20100101 Firefox/40.1"
+STREAM_THRESHOLD = 16 * 1024 * 1024  # markdown files larger than this (bytes) are read and written in chunks
+STREAM_CHUNK = 1024 * 1024  # characters read at a time from such a file
+LOG_LINKS = False  # log the messages about every link, else only one in LINK_LOG_SAMPLE of them
+LINK_LOG_SAMPLE = 100
+link_log_count = 0
+
+
+def log_link(message: str) -> None:
+    """Log a message about one link (or file) at INFO level, sampled unless LOG_LINKS is set"""
+    global link_log_count
+    link_log_count += 1
+    if LOG_LINKS or link_log_count % LINK_LOG_SAMPLE == 1:
+        logging.info(message)
+
+
+class TransientDownloadError(Exception):
+    """A download failure which may not happen again, e.g. a timeout or a 429/5xx response"""
+
+    def __init__(self, message: str, retry_after: float = None) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after  # seconds asked by the server with Retry-After
+
+
+class DownloadContext:
+    """
+    State shared by all the image downloads of one download() call.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, coroutine_num: int, max_bytes: int = MAX_IMAGE_BYTES,
+                 memory_budget: int = MEMORY_BUDGET, cache: Manifest = None, refresh: bool = False,
+                 retries: int = RETRIES, per_host_num: int = None, metrics: Metrics = None,
+                 adaptive: bool = False, max_coroutine_num: int = MAX_COROUTINE_NUM, optimize: Dict = None,
+                 optimize_pool: ProcessPoolExecutor = None) -> None:
+        self.session = session
+        # in adaptive mode, the limit of each host is tuned from coroutine_num up to per_host_num,
+        # and max_coroutine_num is the global ceiling
+        self.adaptive = adaptive
+        # the number of downloads running at the same time over all hosts
+        self.semaphore = asyncio.Semaphore(max_coroutine_num if adaptive else coroutine_num)
+        self.coroutine_num = coroutine_num
+        # limit the coroutines of each host, by default to half of the global slots,
+        # so that a slow host can not take all of them
+        self.per_host_num = per_host_num if per_host_num else \
+            max(1, (max_coroutine_num if adaptive else coroutine_num) // 2)
+        self.host_semaphores = {}
+        # one token for every chunk that may be in memory at the same time
+        self.budget = asyncio.Semaphore(max(1, memory_budget // CHUNK_SIZE))
+        self.max_bytes = max_bytes
+        # where the ETag, Last-Modified and Content-Length of the responses are saved
+        self.cache = cache
+        # whether to revalidate the images which are already downloaded
+        self.refresh = refresh
+        self.retries = retries
+        self.stats = {"downloaded": 0, "revalidated": 0, "failed": 0, "retried": 0}
+        self.url_blobs = {}  # url -> future of its blob path in the store
+        self.metrics = metrics
+        # options of the optimization and the pool running optimize_image, if the images are optimized
+        self.optimize = optimize
+        self.optimize_pool = optimize_pool
+        self.optimized = {"images": 0, "before": 0, "after": 0}
+
+    def count(self, stat: str) -> None:
+        """Count an outcome of a download in stats and in the metrics of the run"""
+        self.stats[stat] = self.stats.get(stat, 0) + 1
+        if self.metrics is not None:
+            self.metrics.count(stat)
+
+    def host_semaphore(self, img_url: str) -> Union[asyncio.Semaphore, AdaptiveLimiter]:
+        host = urllib.parse.urlsplit(img_url).netloc
+        if host not in self.host_semaphores:
+            self.host_semaphores[host] = AdaptiveLimiter(host, self.coroutine_num, self.per_host_num) \
+                if self.adaptive else asyncio.Semaphore(self.per_host_num)
+        return self.host_semaphores[host]
+
+    async def optimize_file(self, file_path: str, img_path: str) -> None:
+        """
+        Optimize the downloaded file_path in the process pool, in its own format, or in the format given by
+        the extension of img_path if the images are converted (image_format).
+        If the optimization fails, the image is kept as it was downloaded.
+        """
+        if self.optimize is None:
+            return
+        time0 = time.perf_counter()
+        try:
+            size_before, size_after = await asyncio.get_event_loop().run_in_executor(
+                self.optimize_pool, optimize_image, file_path, os.path.splitext(img_path)[1],
+                self.optimize.get("max_dimension"), bool(self.optimize.get("image_format")))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # e.g. a worker of the pool died, the download itself succeeded
+            logging.warning(f"Could not optimize {img_path}: {e}")
+            return
+        self.optimized["images"] += 1
+        self.optimized["before"] += size_before
+        self.optimized["after"] += size_after
+        logging.info(f"Optimized {img_path}: {size_before} -> {size_after} bytes")
+        if self.metrics is not None:
+            self.metrics.add_time("optimize", time.perf_counter() - time0)
+            self.metrics.count("optimized")
+            self.metrics.count("optimize_bytes_before", size_before)
+            self.metrics.count("optimize_bytes_after", size_after)
+
+    def log_limits(self) -> None:
+        """Log the concurrency limits chosen for each host in adaptive mode, and save them in the metrics"""
+        if not self.adaptive:
+            return
+        for host, limiter in self.host_semaphores.items():
+            logging.warning(f"Concurrency limit of {host}: {int(limiter.limit)} "
+                            f"(max {int(limiter.max_reached)}, ceiling {limiter.max_limit})")
+            if self.metrics is not None:
+                self.metrics.set_concurrency_limit(host, int(limiter.limit), int(limiter.max_reached))
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Return the delay in seconds of a Retry-After header (in seconds or as a date), capped by MAX_RETRY_AFTER"""
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            delay = (email.utils.parsedate_to_datetime(value) -
+                     datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0.0), MAX_RETRY_AFTER)
+
+
+def range_validator(status: int, headers) -> Optional[str]:
+    """
+    The validator to resume a response with (in If-Range): its strong ETag, else its Last-Modified,
+    or None if the server does not accept range requests
+    """
+    if status != 206 and headers.get("Accept-Ranges", "").lower() != "bytes":
+        return None
+    etag = headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return headers.get("Last-Modified")
+
+
+def parse_content_range(value: Optional[str]) -> Tuple[Optional[int], Optional[int]]:
+    """Return the start and the total length of a "bytes start-end/total" Content-Range, None when unknown"""
+    m = re.match(r"bytes (\d+)-\d+/(\d+|\*)", value or "")
+    if m is None:
+        return None, None
+    return int(m.group(1)), None if m.group(2) == "*" else int(m.group(2))
+
+
+def load_part(part_path: str, img_url: str) -> Tuple[int, Optional[str]]:
+    """
+    Return the size of the partial download part_path of img_url and the validator to resume it with,
+    or (0, None) if there is none or it can not be resumed, in which case it is removed
+    """
+    try:
+        with open(part_path + ".json", "r", encoding="utf-8") as f:
+            info = json.load(f)
+        size = os.path.getsize(part_path)
+        if info.get("url") == img_url and info.get("validator") and size:
+            return size, info["validator"]
+    except (OSError, ValueError):
+        pass
+    discard_part(part_path)
+    return 0, None
+
+
+def save_part_info(part_path: str, img_url: str, validator: str) -> None:
+    """Save next to the partial download part_path what is needed to resume it"""
+    with open(part_path + ".json", "w", encoding="utf-8") as f:
+        json.dump({"url": img_url, "validator": validator}, f)
+
+
+def discard_part(part_path: str) -> None:
+    for path in (part_path, part_path + ".json"):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def hash_file(sha256, file_path: str) -> None:
+    """Update sha256 with the content of file_path"""
+    with open(file_path, "rb") as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+            sha256.update(chunk)
+
+
+async def fetch_to_file(
+    ctx: DownloadContext,
+    img_url: str,
+    file_path: Union[str, io.BytesIO],
+    digest: bool = False,
+    conditional: bool = False
+) -> Optional[str]:
+    """
+    Stream the image from the link to file_path in CHUNK_SIZE chunks, or to memory if file_path is a BytesIO.
+    Every chunk in memory holds one token of ctx.budget until it is written, and the writes run in a thread
+    so that the event loop never waits for the disk. Images larger than ctx.max_bytes are given up.
+    The image is only complete if it has the length announced by Content-Length (or Content-Range).
+    An interrupted download is kept in file_path if the server accepts range requests, with its validator
+    in file_path + ".json", and the next call only requests the missing bytes (Range and If-Range);
+    the server answers with the whole image if it changed in the meantime.
+    If conditional is True, the request is made conditional on the validators saved in ctx.cache.
+    Return the sha256 of the image if digest is True (else an empty string), NOT_MODIFIED if the image did not change,
+    or None if the download failed. Raise TransientDownloadError if it is worth retrying.
+    """
+    loop = asyncio.get_event_loop()
+    sha256 = hashlib.sha256() if digest else None
+    size = 0
+    complete = False
+    resumable = False  # whether file_path can be resumed if the download is interrupted
+    error = None
+    headers = {}
+    validators = ctx.cache.get_validators(img_url) if ctx.cache is not None else None
+    limiter = ctx.host_semaphore(img_url) if ctx.adaptive else None
+    in_memory = isinstance(file_path, io.BytesIO)
+    offset, validator = (0, None) if in_memory else \
+        await loop.run_in_executor(None, load_part, file_path, img_url)
+    try:
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+        elif conditional and validators:
+            # without an ETag or a Last-Modified, the image is downloaded again
+            etag, last_modified = validators[:2]
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+        request_start = loop.time()
+        async with ctx.session.get(img_url, headers=headers) as img:
+            if limiter is not None:
+                if img.status == 429 or img.status >= 500:
+                    limiter.on_congestion(loop.time())
+                else:
+                    limiter.on_success(loop.time() - request_start)
+            if img.status == 304:
+                return NOT_MODIFIED
+            # the length of the whole image, if known
+            expected = None if img.content_length is None or img.headers.get("Content-Encoding") else \
+                img.content_length
+            resumed = img.status == 206
+            if resumed:
+                start, expected = parse_content_range(img.headers.get("Content-Range"))
+                if start != offset:
+                    logging.error(f"Unexpected Content-Range {img.headers.get('Content-Range')}: {img_url}")
+            if img.status == 416 or resumed and start != offset:
+                # the partial download can not be resumed, it is started again
+                offset = 0
+                error = TransientDownloadError(f"HTTP {img.status}")
+            elif img.status == 429 or img.status >= 500:
+                error = TransientDownloadError(
+                    f"HTTP {img.status}", parse_retry_after(img.headers.get("Retry-After")))
+            elif img.status >= 400:
+                logging.error(f"Error {img.status} when downloading {img_url}...")
+            elif expected is not None and expected > ctx.max_bytes:
+                logging.error(
+                    f"Image too large ({expected} bytes): {img_url}")
+            else:
+                if resumed:
+                    size = offset
+                    ctx.count("resumed")
+                    log_link(f"Resuming {img_url} at {offset} bytes\n")
+                    if sha256 is not None:
+                        await loop.run_in_executor(None, hash_file, sha256, file_path)
+                f = file_path if in_memory else \
+                    await loop.run_in_executor(None, open, file_path, 'ab' if resumed else 'wb')
+                if not in_memory:
+                    validator = range_validator(img.status, img.headers)
+                    if validator:
+                        await loop.run_in_executor(None, save_part_info, file_path, img_url, validator)
+                        resumable = True
+                try:
+                    while True:
+                        async with ctx.budget:
+                            chunk = await img.content.read(CHUNK_SIZE)
+                            if not chunk:
+                                if expected is not None and size != expected:
+                                    error = TransientDownloadError(f"Incomplete body: {size} of {expected} bytes")
+                                else:
+                                    complete = True
+                                break
+                            size += len(chunk)
+                            if size > ctx.max_bytes:
+                                logging.error(
+                                    f"Image too large (over {ctx.max_bytes} bytes): {img_url}")
+                                break
+                            if sha256 is not None:
+                                sha256.update(chunk)
+                            if ctx.metrics is not None:
+                                ctx.metrics.add_bytes(img_url, len(chunk))
+                            if in_memory:
+                                f.write(chunk)
+                            else:
+                                await loop.run_in_executor(None, f.write, chunk)  # save img
+                finally:
+                    if not in_memory:
+                        await loop.run_in_executor(None, f.close)
+                if complete and ctx.cache is not None:
+                    ctx.cache.set_validators(img_url, img.headers.get("ETag"),
+                                             img.headers.get("Last-Modified"), size)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        error = TransientDownloadError(type(e).__name__)
+        if limiter is not None:
+            limiter.on_congestion(loop.time())
+    except OSError as e:
+        # the image can not be written (e.g. its folder is missing or the disk is full), the download failed
+        logging.error(f"Error when saving {img_url} to {file_path}: {e}")
+    if not complete:
+        if in_memory:
+            file_path.seek(0)
+            file_path.truncate()
+        elif not (resumable and error is not None and os.path.exists(file_path) and os.path.getsize(file_path)):
+            # keep the partial download only if it can be resumed
+            discard_part(file_path)
+        if error is not None:
+            raise error
+        return None
+    if not in_memory and os.path.exists(file_path + ".json"):
+        os.remove(file_path + ".json")
+    return sha256.hexdigest() if sha256 is not None else ""
+
+
+async def fetch_with_retry(
+    ctx: DownloadContext,
+    img_url: str,
+    file_path: Union[str, io.BytesIO],
+    digest: bool = False,
+    conditional: bool = False
+) -> Optional[str]:
+    """
+    Run fetch_to_file within the limits of the host and of the whole download, and retry it up to ctx.retries times
+    on transient failures, after the delay asked by Retry-After or else an exponential backoff with full jitter.
+    No slot is held while waiting for a retry.
+    """
+    for attempt in range(ctx.retries + 1):
+        wait_start = time.perf_counter()
+        try:
+            async with ctx.host_semaphore(img_url), ctx.semaphore:
+                if ctx.metrics is None:
+                    return await fetch_to_file(ctx, img_url, file_path, digest, conditional)
+                request_start = time.perf_counter()
+                ctx.metrics.add_wait(request_start - wait_start)
+                outcome = "error"
+                try:
+                    result = await fetch_to_file(ctx, img_url, file_path, digest, conditional)
+                    outcome = "failed" if result is None else "not-modified" if result == NOT_MODIFIED else "ok"
+                    return result
+                except TransientDownloadError as e:
+                    outcome = str(e)
+                    raise
+                finally:
+                    ctx.metrics.add_request(img_url, outcome, time.perf_counter() - request_start)
+        except TransientDownloadError as e:
+            if attempt == ctx.retries:
+                logging.error(f"Error when downloading {img_url}: {e}")
+                return None
+            delay = e.retry_after if e.retry_after is not None else \
+                random.uniform(0, min(MAX_BACKOFF, BACKOFF_BASE * 2 ** attempt))
+            ctx.count("retried")
+            log_link(f"Retrying {img_url} in {delay:.2f}s: {e}")
+            if ctx.metrics is not None:
+                ctx.metrics.add_time("backoff", delay)
+            await asyncio.sleep(delay)
+
+
+def count_result(ctx: DownloadContext, img_url: str, result: Optional[str]) -> None:
+    if result is None:
+        ctx.count("failed")
+    elif result == NOT_MODIFIED:
+        ctx.count("revalidated")
+        log_link(f"Not modified: {img_url}\n")
+    else:
+        ctx.count("downloaded")
 
 
 async def image_download(
-    session: aiohttp.ClientSession,
+    ctx: DownloadContext,
     img_url: str,
-    img_path: str,
-    semaphore: asyncio.Semaphore
+    img_path: str
 ) -> None:
     """
     Download the image from the link and save it to img_path.
     """
-    async with semaphore:
-        # 如果下载图片不存在，再下载，防止重复下载文件
-        if not os.path.exists(img_path):
-            try:
-                img = await session.get(img_url)
-                content = await img.read()
-                with open(img_path, 'wb') as f:
-                    f.write(content)  # save img
-            except aiohttp.ClientError as e:
-                logging.error(f"Error when downloading {img_url}...")
+    exists = os.path.exists(img_path)
+    # 如果下载图片不存在，再下载，防止重复下载文件
+    if not exists or ctx.refresh:
+        # a partial file keeps img_path missing (or unchanged) until the image is complete,
+        # and is resumed by the next run if the download is interrupted
+        tmp_path = img_path + PART_SUFFIX
+        result = await fetch_with_retry(ctx, img_url, tmp_path, conditional=exists)
+        count_result(ctx, img_url, result)
+        if result is not None and result != NOT_MODIFIED:
+            await ctx.optimize_file(tmp_path, img_path)
+            os.replace(tmp_path, img_path)
+    else:
+        ctx.count("skipped")
+        log_link(f"Skipped file: {img_path}\n")
+
+
+async def store_download(
+    ctx: DownloadContext,
+    img_url: str,
+    img_paths: List[str],
+    store: AssetStore
+) -> None:
+    """
+    Download the image from the link once, save it in the store and link it to every path of img_paths.
+    """
+    exists = all(os.path.exists(img_path) for img_path in img_paths)
+    if not ctx.refresh:
+        img_paths = [img_path for img_path in img_paths if not os.path.exists(img_path)]
+        if not img_paths:
+            ctx.count("skipped")
+            log_link(f"Skipped url: {img_url}\n")
+            return
+    # the same url may come again for other paths (see the url_queue of download), it is only fetched once
+    if img_url in ctx.url_blobs:
+        blob_path = await ctx.url_blobs[img_url]
+        if blob_path is not None:
+            for img_path in img_paths:
+                if not os.path.exists(img_path):
+                    store.link(blob_path, img_path)
+        return
+    ctx.url_blobs[img_url] = asyncio.get_event_loop().create_future()
+    tmp_path = store.part_path(img_url)
+    digest = await fetch_with_retry(ctx, img_url, tmp_path, digest=True, conditional=exists)
+    count_result(ctx, img_url, digest)
+    if digest is None or digest == NOT_MODIFIED:
+        ctx.url_blobs[img_url].set_result(None)
+        return
+    # the blob is keyed by the digest of the downloaded image, and holds it optimized if the images are optimized
+    await ctx.optimize_file(tmp_path, img_paths[0])
+    blob_path = store.add_file(tmp_path, digest)
+    ctx.url_blobs[img_url].set_result(blob_path)
+    for img_path in img_paths:
+        if os.path.exists(img_path):
+            os.remove(img_path)
+        store.link(blob_path, img_path)
+
+
+def create_download_tasks(ctx: DownloadContext, url_dict: Dict[str, Union[str, List[str]]], out_folder_path: str,
+                          store: AssetStore = None) -> List[asyncio.Future]:
+    """Start the download of the images of url_dict to out_folder_path, return their tasks"""
+    tasks = []
+    for img_url, img_paths in url_dict.items():
+        if store is not None:
+            img_paths = img_paths if isinstance(img_paths, list) else [img_paths]
+            tasks.append(asyncio.ensure_future(store_download(ctx, img_url, [os.path.join(
+                out_folder_path, img_path) for img_path in img_paths], store)))
+        elif isinstance(img_paths, list):
+            for img_path in img_paths:
+                tasks.append(asyncio.ensure_future(image_download(ctx, img_url, os.path.join(
+                    out_folder_path, img_path))))
         else:
-            logging.info(f"Skipped file: {img_path}\n")
+            tasks.append(asyncio.ensure_future(image_download(ctx, img_url, os.path.join(
+                out_folder_path, img_paths))))
+    if ctx.metrics is not None:
+        ctx.metrics.count("queued", len(tasks))
+    return tasks
 
 
-async def download(url_dict: Dict[str, str], out_folder_path: str, coroutine_num: int) -> None:
+async def download(url_dict: Dict[str, str], out_folder_path: str, coroutine_num: int,
+                   store: AssetStore = None, max_bytes: int = MAX_IMAGE_BYTES,
+                   memory_budget: int = MEMORY_BUDGET, cache: Manifest = None, refresh: bool = False,
+                   retries: int = RETRIES, per_host_num: int = None, connect_timeout: float = CONNECT_TIMEOUT,
+                   read_timeout: float = READ_TIMEOUT, user_agent: str = USER_AGENT,
+                   url_queue: asyncio.Queue = None, metrics: Metrics = None, adaptive: bool = False,
+                   max_coroutine_num: int = MAX_COROUTINE_NUM, optimize: Dict = None,
+                   session: aiohttp.ClientSession = None) -> None:
     """
     Download images in url_dict, use async to speed up.
+    The images are downloaded through session if given (its timeouts and headers are used then, and it is not closed),
+    else through a new session.
+    If a store is given, every url is only fetched once and its paths are linked to the stored image.
+    Images are streamed to disk, at most memory_budget bytes of them are held in memory at any time
+    and images larger than max_bytes are skipped.
+    If a cache is given, the validators of the responses are saved in it, and if refresh is True the images
+    already downloaded are revalidated with conditional requests instead of being skipped.
+    Transient failures are retried up to retries times, and at most per_host_num images of the same host
+    are downloaded at the same time (by default half of the global limit, so that a slow host leaves slots
+    for the others).
+    If a url_queue is given, the (out_folder_path, url_dict) put on it are downloaded as well, until None is put.
+    If metrics are given, the requests, bytes, retries and waits of the downloads are recorded in them.
+    If adaptive is True, the number of concurrent downloads of each host is tuned from the responses
+    (see AdaptiveLimiter), starting at coroutine_num, up to per_host_num and max_coroutine_num over all hosts.
+    If optimize is given (its max_dimension, the image_format of the local names and the workers of its pool),
+    every downloaded image is optimized in a process pool, while the other images are downloaded.
     """
-    semaphore = asyncio.Semaphore(
-        coroutine_num)  # limit max coroutine numbers to 2
-    # Create session which contains a connection pool
-    async with aiohttp.ClientSession() as session:
+    time0 = time.perf_counter()
+    own_session = session is None
+    if own_session:
+        timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout, sock_read=read_timeout)
+        # Create session which contains a connection pool
+        session = aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": user_agent})
+    optimize_pool = ProcessPoolExecutor(optimize.get("workers")) if optimize is not None else None
+    try:
+        ctx = DownloadContext(session, coroutine_num, max_bytes,
+                              memory_budget, cache, refresh, retries, per_host_num, metrics,
+                              adaptive, max_coroutine_num, optimize, optimize_pool)
         # Create all tasks
         # await asyncio.gather(*[image_download(session, img_url, os.path.join(out_folder_path, img_path), semaphore)
         #                        for img_url, img_path in url_dict.items()])
-        tasks = []
-        for img_url, img_paths in url_dict.items():
-            if isinstance(img_paths, list):
-                for img_path in img_paths:
-                    tasks.append(image_download(session, img_url, os.path.join(
-                        out_folder_path, img_path), semaphore))
-            else:
-                tasks.append(image_download(session, img_url, os.path.join(
-                    out_folder_path, img_paths), semaphore))
-
+        tasks = create_download_tasks(ctx, url_dict, out_folder_path, store)
+        if url_queue is not None:
+            while True:
+                item = await url_queue.get()
+                if item is None:
+                    break
+                tasks += create_download_tasks(ctx, item[1], item[0], store)
         await asyncio.gather(*tasks)
-
-
-def download_images(url_dict: Dict[str, str], folder_path: str, user_agent: str) -> None:
-    """
-    Download the images (not async) from the links obtained from the markdown files to the "destination folder"
-    The user-agent can be specified in order to circumvent some simple potential connection block
-    """
-    for url, name in url_dict.items():
-        if not is_valid_url(url):
-            logging.warning(f"Not valid url:{url}")
-            continue
-        opener = urllib.request.build_opener()
-        opener.addheaders = [('User-agent', user_agent)]
-        urllib.request.install_opener(opener)
-        save_name = os.path.join(folder_path, name)
-        try:
-            urllib.request.urlretrieve(url, save_name)
-        except Exception as e:
-            logging.exception(f"Error when downloading {url}")
+        ctx.log_limits()
+    finally:
+        if optimize_pool is not None:
+            optimize_pool.shutdown()
+        if own_session:
+            await session.close()
+    if metrics is not None:
+        metrics.add_time("download", time.perf_counter() - time0)
+    if cache is not None:
+        cache.commit()
+    if store is not None:
+        logging.warning(f"Linked images from the store: {store.links}")
+    if refresh:
+        logging.warning(
+            f"Revalidated {ctx.stats['revalidated']} images, re-downloaded {ctx.stats['downloaded']} images, "
+            f"{ctx.stats['failed']} failed")
+    if ctx.stats["retried"]:
+        logging.warning(f"Retried {ctx.stats['retried']} downloads")
+    if ctx.stats.get("resumed"):
+        logging.warning(f"Resumed {ctx.stats['resumed']} interrupted downloads")
+    if ctx.optimized["images"]:
+        logging.warning(f"Optimized {ctx.optimized['images']} images: {ctx.optimized['before'] / 1024 / 1024:.2f} MB "
+                        f"-> {ctx.optimized['after'] / 1024 / 1024:.2f} MB")
 
 
 def open_and_read(file_path: str) -> str:
@@ -124,17 +622,66 @@ def delete_image_url_json(out_folder_path: str) -> None:
     os.remove(os.path.join(out_folder_path, 'all_img_dict.json'))
 
 
-def create_url2local_dict(regex: str, file_data: str, file_name: str) -> Dict[str, str]:
+def add_to_img_dict(all_img_dict: Dict[str, Union[str, List[str]]], url_dict: Dict[str, str]) -> None:
+    """
+    Add the url and path of url_dict to all_img_dict, an url with several paths gets a list of paths
+    """
+    for key, value in url_dict.items():
+        if key in all_img_dict and all_img_dict[key] != value:
+            if not isinstance(all_img_dict[key], list):
+                all_img_dict[key] = [all_img_dict[key]]
+            if value not in all_img_dict[key]:
+                all_img_dict[key].append(value)
+        else:
+            all_img_dict[key] = value
+
+
+def find_fail_dict(all_img_dict: Dict[str, Union[str, List[str]]], out_folder_path: str) -> Dict[str, str]:
+    """
+    Collect the images of all_img_dict which are still missing on disk, as a dict of url and path
+    """
+    fail_dict = {}
+    for url, names in all_img_dict.items():
+        if isinstance(names, list):
+            for name in names:
+                if not os.path.exists(os.path.join(out_folder_path, name)):
+                    fail_dict.update({url: name})
+        else:
+            if not os.path.exists(os.path.join(out_folder_path, names)):
+                fail_dict.update({url: names})
+    return fail_dict
+
+
+def find_url_spans(regex: Optional[str], file_data: str) -> List[Tuple[int, int, str, str]]:
+    """
+    Find(regex) the image links of file_data in one pass per pattern, and return them sorted by position as
+    (start, end, url, end) tuples, where start:end is the span of the url in file_data and end is its last part
+    If regex is None, the linear scanner scan_image_links is used instead of the regexes
+    """
+    if regex is None:
+        return scan_image_links(file_data)
+    url_spans = [(m.start("url"), m.end("url"), m.group("url"), m.group("end"))
+                 for m in re.finditer(regex, file_data)]
+    # 匹配<img>标签的图片链接
+    url_spans += [(m.start() + 5, m.end() - 1, m.group()[5:-1], m.group()[-5:-1])
+                  for m in re.finditer("src=\"[a-zA-z]+://[^\s]*\"", file_data)]
+    url_spans.sort()
+    return url_spans
+
+
+def create_url2local_dict(regex: Optional[str], file_data: str, file_name: str,
+                          url_spans: List[Tuple[int, int, str, str]] = None) -> Dict[str, str]:
     """
      Find(regex) URL's for images on the received "file_data" and creates a dictionary with the url's for later download
      as keys and a random 10 digit number followed by the images names (something.jpg) in order to save the files later
      and prevent name collisions
+     url_spans can be given if find_url_spans has already been run on file_data
     """
     url_dict = {}
     try:
-        urls = re.findall(regex, file_data)
-        urls += [[url[5:-1], url[-5:-1]]
-                 for url in re.findall("src=\"[a-zA-z]+://[^\s]*\"", file_data)]  # 匹配<img>标签的图片链接
+        if url_spans is None:
+            url_spans = find_url_spans(regex, file_data)
+        urls = [url_span[2:] for url_span in url_spans]
         for url in urls:
             random_name = "".join(
                 [random.choice(string.hexdigits) for i in range(10)])
@@ -163,15 +710,298 @@ def create_url2local_dict(regex: str, file_data: str, file_name: str) -> Dict[st
     return url_dict
 
 
-def file_replace_url(file_data: str, url_dict: Dict[str, str], file_name: str) -> str:
+def build_urls_regex(urls: List[str]) -> str:
+    """
+    Build a regex matching any of the urls, in the form of a trie of their characters so that a match costs
+    the length of the url (and not the number of urls), and the longest url is matched when one is a prefix of another
+    """
+    trie = {}
+    for url in urls:
+        node = trie
+        for char in url:
+            node = node.setdefault(char, {})
+        node[""] = {}  # a url ends here
+
+    def node_regex(node: Dict) -> str:
+        branches = []
+        for char, child in sorted(node.items()):
+            if not char:
+                continue
+            # follow the chain of single characters without recursion
+            literal = char
+            while len(child) == 1 and "" not in child:
+                char, child = next(iter(child.items()))
+                literal += char
+            branches.append(re.escape(literal) + node_regex(child))
+        if not branches:
+            return ""
+        regex = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # a longer url is tried first, then the one ending here
+        return "(?:" + regex + ")?" if "" in node else regex
+
+    return node_regex(trie)
+
+
+def file_replace_url(file_data: str, url_dict: Dict[str, str], file_name: str,
+                     url_spans: List[Tuple[int, int, str, str]] = None) -> str:
     """
     Edit the markdown files, changing the url's links for a new name corresponding to the name of the local file
     images that will be downloaded later
+    The new content is built in one pass: from url_spans if given (only these spans are replaced),
+    else by matching all the urls at once with build_urls_regex
     """
-    for key, value in url_dict.items():
-        file_data = file_data.replace(key, value)
-        logging.info(f"replaced: {key}\nwith: {value}\non file: {file_name}\n")
-    return file_data
+    parts = []
+    pos = 0
+    if url_spans is None:
+        if not url_dict:
+            return file_data
+        url_regex = build_urls_regex(url_dict)
+        url_spans = [(m.start(), m.end(), m.group(), "")
+                     for m in re.finditer(url_regex, file_data)]
+    for start, end, url, _ in url_spans:
+        # overlapping spans (e.g. an <img> tag inside a markdown link) are only replaced once
+        if start < pos or url not in url_dict:
+            continue
+        parts.append(file_data[pos:start])
+        parts.append(url_dict[url])
+        pos = end
+    parts.append(file_data[pos:])
+    log_link(f"replaced {len(parts) // 2} links on file: {file_name}\n")
+    return "".join(parts)
+
+
+def assets_url_dict(url_dict: Dict[str, str], filename: str, local_paths: Dict[str, str] = None,
+                    image_format: str = None) -> Dict[str, str]:
+    """
+    Turn the names of url_dict into local paths in the .assets folder of the file filename.
+    The urls of local_paths keep the local path given there.
+    If image_format is given, the local names of the images which will be converted get its extension.
+    """
+    # Specify img folder
+    url_dict = {key: os.path.join(
+        filename[:-3] + ".assets", converted_name(value, image_format)) for key, value in url_dict.items()}
+    if local_paths:
+        url_dict.update({key: value for key, value in local_paths.items() if key in url_dict})
+    return url_dict
+
+
+def localize_md_text(file_data: str, filename: str, regex: Optional[str], local_paths: Dict[str, str] = None,
+                     stage_times: Dict[str, float] = None, image_format: str = None) -> Tuple[str, Dict[str, str]]:
+    """
+    Replace the image urls of the markdown text file_data of the file filename by local paths in its .assets folder,
+    return the new text and the url dict. See assets_url_dict for local_paths and image_format.
+    If stage_times is given, the time spent scanning, parsing and rewriting the text is added to it.
+    """
+    time0 = time.perf_counter()
+    # Create a dictionary of images URLs for each file
+    url_spans = find_url_spans(regex, file_data)
+    time1 = time.perf_counter()
+    url_dict = create_url2local_dict(
+        regex, file_data, filename, url_spans)
+    time2 = time.perf_counter()
+    edited_file_data = file_data
+    if url_dict:
+        url_dict = assets_url_dict(url_dict, filename, local_paths, image_format)
+        # Edit the read content of each file, replacing the found imgs urls with local file names instead
+        edited_file_data = file_replace_url(
+            file_data, url_dict, filename, url_spans)
+    if stage_times is not None:
+        for stage, seconds in (("scan", time1 - time0), ("parse", time2 - time1),
+                               ("rewrite", time.perf_counter() - time2)):
+            stage_times[stage] = stage_times.get(stage, 0.0) + seconds
+    return edited_file_data, url_dict
+
+
+def localize_md_stream(reader: TextIO, writer: TextIO, filename: str, assets_path: str,
+                       url_dict: Optional[Dict[str, str]], local_paths: Dict[str, str] = None,
+                       image_format: str = None, extract_data_uris: bool = False,
+                       chunk_size: int = STREAM_CHUNK) -> int:
+    """
+    Copy the markdown text of the file filename from reader to writer chunk by chunk, so that only about chunk_size
+    characters are held in memory whatever the size of the file, and:
+    - if url_dict is not None, replace its image urls by local paths as localize_md_text does, and add them to url_dict.
+      Reference-style images are left as they are, their definition may be in another chunk;
+    - if extract_data_uris is True, decode the images embedded as base64 data uris into assets_path (its .assets
+      folder) and replace them by their local path. Their payload is decoded as it is read, however long it is.
+    The links starting in the last MAX_LINK_LENGTH characters of a chunk are scanned with the next chunk,
+    so that the links crossing the end of a chunk are found as if the text was scanned at once.
+    Return the number of embedded images extracted.
+    """
+    prefix = filename[:-3] + ".assets"
+    extracted = 0
+
+    def write_localized(text: str, stop: int = None) -> int:
+        """Write text with its links starting before stop localized, up to their end (at least to stop)"""
+        if url_dict is None:
+            writer.write(text if stop is None else text[:stop])
+            return len(text) if stop is None else stop
+        url_spans = scan_image_links(text, stop, references=False)
+        new_urls = [url_span for url_span in url_spans if url_span[2] not in url_dict]
+        if new_urls:
+            url_dict.update(assets_url_dict(create_url2local_dict(None, text, filename, new_urls),
+                                            filename, local_paths, image_format))
+        end = len(text) if stop is None else max([stop] + [url_span[1] for url_span in url_spans])
+        writer.write(file_replace_url(text[:end], url_dict, filename, url_spans) if url_spans else text[:end])
+        return end
+
+    buffer = ""
+    while True:
+        chunk = reader.read(chunk_size)
+        eof = not chunk
+        buffer += chunk
+        finder = TextFinder(buffer)
+        pos = 0
+        while extract_data_uris:
+            # the links starting before len(buffer) - MAX_LINK_LENGTH are complete in buffer
+            found = find_data_uri(finder, pos)
+            if found is None or not eof and found[0] >= len(buffer) - MAX_LINK_LENGTH:
+                break
+            start, m = found
+            write_localized(buffer[pos:start])
+            writer.write(buffer[start:m.start("uri")])
+            image = EmbeddedImage(assets_path, m.group("type"))
+            try:
+                pos = m.end()
+                while True:
+                    payload_end = BASE64_REGEX.match(buffer, pos).end()
+                    image.feed(buffer[pos:payload_end])
+                    if payload_end < len(buffer) or eof:
+                        break
+                    buffer, pos = reader.read(chunk_size), 0
+                    finder = TextFinder(buffer)
+                    eof = not buffer
+                name = image.close()
+            except BaseException:
+                image.abort()
+                raise
+            if name is None:
+                writer.write(m.group("uri"))
+            else:
+                writer.write(os.path.join(prefix, name))
+                extracted += 1
+            pos = payload_end
+        if eof:
+            write_localized(buffer[pos:])
+            return extracted
+        rest = buffer[pos:]
+        buffer = rest[write_localized(rest, max(0, len(rest) - MAX_LINK_LENGTH)):]
+
+
+def extract_md_data_uris(file_data: str, filename: str, assets_path: str) -> Tuple[str, int]:
+    """
+    Decode the images embedded as base64 data uris in the markdown text file_data of the file filename
+    into assets_path, its .assets folder, return the text with their local paths instead and their number
+    """
+    writer = io.StringIO()
+    extracted = localize_md_stream(io.StringIO(file_data), writer, filename, assets_path, None,
+                                   extract_data_uris=True)
+    return (writer.getvalue(), extracted) if extracted else (file_data, 0)
+
+
+def localize_md_file(md_path: str, out_folder_path: str, filename: str, regex: Optional[str],
+                     local_paths: Dict[str, str] = None, stage_times: Dict[str, float] = None,
+                     image_format: str = None, extract_data_uris: bool = False) -> Dict[str, str]:
+    """
+    Replace the image urls of the markdown file md_path/filename by local paths, write the new file in out_folder_path
+    and return its url dict, see localize_md_text.
+    If extract_data_uris is True, the images embedded as base64 data uris are also saved in the .assets folder
+    and replaced by their local path, see localize_md_stream.
+    Files larger than STREAM_THRESHOLD are read and written in chunks, with the linear scanner whatever regex is.
+    This is a module level function so that it can run in a process pool.
+    """
+    file_path = os.path.join(md_path, filename)
+    assets_path = os.path.join(out_folder_path, filename[:-3] + ".assets")
+    if os.path.isfile(file_path) and os.path.getsize(file_path) > STREAM_THRESHOLD:
+        return localize_md_file_streaming(file_path, out_folder_path, filename, local_paths, stage_times,
+                                          image_format, extract_data_uris)
+    # Open and read each file
+    file_data = open_and_read(file_path)
+    if file_data is None:
+        return {}
+    extracted = 0
+    if extract_data_uris:
+        file_data, extracted = extract_md_data_uris(file_data, filename, assets_path)
+    edited_file_data, url_dict = localize_md_text(
+        file_data, filename, regex, local_paths, stage_times, image_format)
+    # skip if no online link in this file
+    if url_dict or extracted:
+        # Create a folder with md filename which contains images
+        create_folder(assets_path)
+        # Write the modified markdown files
+        write_file(out_folder_path,
+                   filename, edited_file_data)
+        if extracted:
+            logging.info(f"Extracted {extracted} embedded images from file: {filename}\n")
+    else:
+        logging.info(f"No url! Skipped file: {filename}\n")
+    logging.info(f"Closed file: {filename}\n")
+    return url_dict
+
+
+def localize_md_file_streaming(file_path: str, out_folder_path: str, filename: str,
+                               local_paths: Dict[str, str] = None, stage_times: Dict[str, float] = None,
+                               image_format: str = None, extract_data_uris: bool = False) -> Dict[str, str]:
+    """
+    localize_md_file for a large file: it is localized chunk by chunk into a temporary file (see localize_md_stream),
+    which then replaces the output file if anything was replaced.
+    """
+    time0 = time.perf_counter()
+    url_dict = {}
+    tmp_path = os.path.join(out_folder_path, filename + ".tmp")
+    try:
+        with open(file_path, "r", encoding="utf-8") as reader, open(tmp_path, "w", encoding="utf-8") as writer:
+            logging.info(f"Streaming file: {file_path}")
+            extracted = localize_md_stream(reader, writer, filename,
+                                           os.path.join(out_folder_path, filename[:-3] + ".assets"), url_dict,
+                                           local_paths, image_format, extract_data_uris)
+    except Exception:
+        logging.exception(f"Error when localizing file {file_path}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        return {}
+    if url_dict or extracted:
+        create_folder(os.path.join(out_folder_path, filename[:-3] + ".assets"))
+        os.replace(tmp_path, os.path.join(out_folder_path, filename))
+        if extracted:
+            logging.info(f"Extracted {extracted} embedded images from file: {filename}\n")
+    else:
+        os.remove(tmp_path)
+        logging.info(f"No url! Skipped file: {filename}\n")
+    if stage_times is not None:
+        stage_times["stream"] = stage_times.get("stream", 0.0) + time.perf_counter() - time0
+    logging.info(f"Closed file: {filename}\n")
+    return url_dict
+
+
+def localize_md_file_timed(md_path: str, out_folder_path: str, filename: str, regex: Optional[str],
+                           local_paths: Dict[str, str] = None, image_format: str = None,
+                           extract_data_uris: bool = False) -> Tuple[Dict[str, str], Dict[str, float]]:
+    """Run localize_md_file in a process pool, return its url dict and the time spent in each stage"""
+    stage_times = {}
+    url_dict = localize_md_file(md_path, out_folder_path, filename, regex, local_paths, stage_times, image_format,
+                                extract_data_uris)
+    return url_dict, stage_times
+
+
+async def collect_and_download(md_locals: List["MdImageLocal"], workers: int, coroutine_num: int,
+                               store: AssetStore = None, **download_options) -> List[Optional[Dict]]:
+    """
+    Localize the markdown files of md_locals in a pool of workers processes, and download the images of every file
+    as soon as it is localized, so that parsing and downloading overlap.
+    Return the url dicts collected by each MdImageLocal, as collect_img_dict.
+    """
+    url_queue = asyncio.Queue()
+    download_task = asyncio.ensure_future(download(
+        {}, "", coroutine_num, store, url_queue=url_queue, **download_options))
+    try:
+        # reseed random in every worker, so that forked workers do not draw the same names
+        with ProcessPoolExecutor(workers, initializer=random.seed) as pool:
+            all_img_dicts = await asyncio.gather(*[md_local.collect_img_dict_pipelined(pool, url_queue)
+                                                   for md_local in md_locals])
+    finally:
+        url_queue.put_nowait(None)
+        await download_task
+    return all_img_dicts
 
 
 def parse_args() -> argparse.Namespace:
@@ -185,6 +1015,72 @@ def parse_args() -> argparse.Namespace:
                         help="whether to modify source md file directly")
     parser.add_argument('--coroutine_num', type=int,
                         default=2, help="number of coroutine")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="number of processes parsing markdown files while downloading (0: parse first)")
+    parser.add_argument('--per_host_num', type=int,
+                        help="max number of coroutines downloading from the same host "
+                             "(default: half of coroutine_num, or of max_coroutine_num with --adaptive)")
+    parser.add_argument('--adaptive', action='store_true',
+                        help="tune the number of coroutines of each host from its latency and 429/5xx responses, "
+                             "starting at coroutine_num")
+    parser.add_argument('--max_coroutine_num', type=int, default=MAX_COROUTINE_NUM,
+                        help="max number of coroutines over all hosts with --adaptive")
+    parser.add_argument('--retries', type=int, default=RETRIES,
+                        help="retries of a download after a timeout or a 429/5xx response")
+    parser.add_argument('--connect_timeout', type=float,
+                        default=CONNECT_TIMEOUT, help="connect timeout of a download (s)")
+    parser.add_argument('--read_timeout', type=float,
+                        default=READ_TIMEOUT, help="read timeout of a download (s)")
+    parser.add_argument('--tree_wide', action='store_true',
+                        help="scan the whole directory tree first, then download all images with one shared session")
+    parser.add_argument('--plan', action='store_true',
+                        help="localize the markdown files, and write the image urls to download split into "
+                             "--shards shards instead of downloading them")
+    parser.add_argument('--shards', type=int, default=4, help="number of shards of --plan")
+    parser.add_argument('--shard', type=parse_shard, metavar='K/N',
+                        help="download only the shard K of the N shards of the plan (K from 1 to N), "
+                             "the shards can run at the same time in several processes or machines")
+    parser.add_argument('--merge', action='store_true',
+                        help="after all shards ran, report the images still missing and record them in the manifest")
+    parser.add_argument('--plan_dir',
+                        help="folder of the plan shared by --plan, --shard and --merge "
+                             "(default: .plan in the output folder)")
+    parser.add_argument('--dedup', action='store_true',
+                        help="fetch each url once, keep each image once and hardlink it to every .assets folder")
+    parser.add_argument('--max_image_mb', type=int,
+                        default=MAX_IMAGE_BYTES // 1024 // 1024, help="skip images larger than this size (MB)")
+    parser.add_argument('--memory_budget_mb', type=int, default=MEMORY_BUDGET // 1024 // 1024,
+                        help="image data held in memory over all downloads (MB)")
+    parser.add_argument('--manifest', action='store_true',
+                        help="keep a manifest of the files and images, re-runs only parse changed files and download new or failed images")
+    parser.add_argument('--refresh', action='store_true',
+                        help="revalidate downloaded images with conditional requests (implies --manifest)")
+    parser.add_argument('--optimize', action='store_true',
+                        help="recompress the downloaded images without loss, in a process pool (needs Pillow)")
+    parser.add_argument('--max_dimension', type=int,
+                        help="downscale the downloaded images to at most this many pixels wide and high "
+                             "(implies --optimize)")
+    parser.add_argument('--image_format', choices=["png", "jpg", "webp"],
+                        help="convert the downloaded png/jpg/webp/bmp/tiff images to this format (implies --optimize)")
+    parser.add_argument('--extract_data_uri', dest='extract_data_uris', action='store_true',
+                        help="save the images embedded as base64 data uris in the .assets folders "
+                             "and replace them by local links")
+    parser.add_argument('--metrics_out', '--metrics-out',
+                        help="write the metrics of the run (stage times, per-host requests, latencies, retries) "
+                             "to this file, as CSV if it ends with .csv, else as JSON")
+    parser.add_argument('--progress', action='store_true',
+                        help="show a live progress line of the downloads")
+    parser.add_argument('--log_links', action='store_true',
+                        help="log every link in the log file, instead of one in %d" % LINK_LOG_SAMPLE)
+    parser.add_argument('--watch', action='store_true',
+                        help="after localizing the directory, keep watching it and localize the new or modified "
+                             "markdown files (inotify where available, else polling)")
+    parser.add_argument('--debounce', type=float, default=DEBOUNCE,
+                        help="seconds without changes before the changed files are localized with --watch")
+    parser.add_argument('--poll_interval', type=float, default=POLL_INTERVAL,
+                        help="seconds between two scans of the directory with --watch when inotify is not used")
+    parser.add_argument('--poll', action='store_true',
+                        help="scan the directory with --watch even if inotify is available")
     parser.add_argument('--del_dict', action='store_true',
                         help="delete all dict")
     parser.add_argument('--test', action='store_true',
@@ -192,17 +1088,56 @@ def parse_args() -> argparse.Namespace:
     return parser.parse_args()
 
 
+def download_options_from_args(args: argparse.Namespace, metrics: Metrics = None) -> Dict:
+    """Extra keyword arguments of download() given on the command line, and the metrics of the run if any"""
+    return {
+        "max_bytes": args.max_image_mb * 1024 * 1024,
+        "memory_budget": args.memory_budget_mb * 1024 * 1024,
+        "refresh": args.refresh,
+        "retries": args.retries,
+        "per_host_num": args.per_host_num,
+        "connect_timeout": args.connect_timeout,
+        "read_timeout": args.read_timeout,
+        "adaptive": args.adaptive,
+        "max_coroutine_num": args.max_coroutine_num,
+        "optimize": {"max_dimension": args.max_dimension, "image_format": args.image_format,
+                     "workers": args.workers or None}
+        if args.optimize or args.max_dimension or args.image_format else None,
+        "metrics": metrics,
+    }
+
+
 class MdImageLocal:
     def __init__(self, md_path: str = os.getcwd(), out_folder_name: str = "out", user_agent: str = None,
-                 log: bool = False, modify_source: bool = False) -> None:
+                 log: bool = False, modify_source: bool = False, dedup: bool = False,
+                 download_options: Dict = None, manifest: Manifest = None, workers: int = 0,
+                 del_dict: bool = False, extract_data_uris: bool = False) -> None:
         self.md_path = md_path  # target md dir
-        self.user_agent = user_agent if user_agent else "Mozilla/5.0 (Windows NT 6.1; WOW64; rv:40.0) Gecko/20100101 Firefox/40.1"
+        self.user_agent = user_agent if user_agent else USER_AGENT
         # Defines the folder to write the new markdown files and the downloaded images
         # if modify_source is True, out_folder_path will be set as md_path
         self.out_folder_path = os.path.abspath(md_path) if modify_source else \
             os.path.abspath(os.path.join(md_path, out_folder_name))
-        self.regex = REGEX_PATTERN
+        self.regex = None  # None to use scan_image_links, or a regex with url and end groups like REGEX_PATTERN
         self.coroutine_num = COROUTINE_NUM
+        # Whether to save each image once in a content-addressed store and link it to the .assets folders
+        self.dedup = dedup
+        # Extra keyword arguments of download(), e.g. max_bytes and memory_budget
+        self.download_options = download_options if download_options else {}
+        # Metrics of the run, shared by all folders, if any
+        self.metrics = self.download_options.get("metrics")
+        # Format the images are converted to when they are optimized, which gives the extension of their local names
+        self.image_format = (self.download_options.get("optimize") or {}).get("image_format")
+        self.modify_source = modify_source
+        # Manifest of the markdown files and images, used instead of all_img_dict.json
+        self.manifest = manifest
+        self.manifest_images = []  # (md file, url, local path) of the images to download from the manifest
+        # Number of processes parsing the markdown files while downloading, 0 to parse first in this process
+        self.workers = workers
+        # Whether to delete the saved all_img_dict.json instead of downloading
+        self.del_dict = del_dict
+        # Whether to save the images embedded as base64 data uris in the .assets folders
+        self.extract_data_uris = extract_data_uris
         # Create new folder to receive the downloaded imgs and edited MD files
         if not modify_source:
             create_folder(self.out_folder_path)  # create new output folder
@@ -211,116 +1146,235 @@ class MdImageLocal:
 
     def run(self) -> None:
         """localize images in this folder's markdown files"""
+        asyncio.get_event_loop().run_until_complete(self.run_async())
+
+    async def run_async(self, session: aiohttp.ClientSession = None) -> Optional[Dict[str, str]]:
+        """
+        localize images in this folder's markdown files, from a running event loop,
+        downloading them through session if given (see download).
+        Return the images which could not be downloaded, as a dict of url and path.
+        The markdown files and the manifest are read and written in a thread, so that the event loop is not blocked.
+        """
+        loop = asyncio.get_event_loop()
+        if self.workers:
+            store = AssetStore(os.path.join(
+                self.out_folder_path, STORE_FOLDER_NAME)) if self.dedup else None
+            all_img_dict = (await collect_and_download(
+                [self], self.workers, self.coroutine_num, store, cache=self.manifest,
+                user_agent=self.user_agent, session=session, **self.download_options))[0]
+            if all_img_dict is None:
+                return None
+        else:
+            all_img_dict = await loop.run_in_executor(None, self.collect_img_dict)
+            if all_img_dict is None:
+                return None
+            store = AssetStore(os.path.join(
+                self.out_folder_path, STORE_FOLDER_NAME)) if self.dedup and all_img_dict else None
+            # Download the images listed on the dictionary of found urls for each file
+            await download(all_img_dict, self.out_folder_path, self.coroutine_num, store, cache=self.manifest,
+                           user_agent=self.user_agent, session=session, **self.download_options)
+        logging.warning(
+            f"\nFiles and the downloaded images on the folder:{self.out_folder_path}")
+        return await loop.run_in_executor(None, self.report_failed, all_img_dict)
+
+    def collect_img_dict(self) -> Optional[Dict[str, Union[str, List[str]]]]:
+        """
+        Rewrite this folder's markdown files and return the url dict of all images to download,
+        or None if there is nothing left to do (the saved dict was deleted by --del_dict).
+        """
+        plan = self.plan_files()
+        if plan is None:
+            return None
+        to_localize, all_img_dict = plan
+        for filename, local_paths in to_localize:
+            # Add url_dict to all_img_dict
+            add_to_img_dict(all_img_dict, self.add_localized(
+                filename, self.localize_file(filename, local_paths)))
+        self.finish_collect(all_img_dict)
+        return all_img_dict
+
+    async def collect_img_dict_pipelined(self, pool: ProcessPoolExecutor,
+                                         url_queue: asyncio.Queue) -> Optional[Dict[str, Union[str, List[str]]]]:
+        """
+        Same as collect_img_dict, but the markdown files are localized in the process pool, and the url dict
+        of each file is put on url_queue (with the output folder) as soon as it is ready, to be downloaded
+        while the other files are still parsed.
+        """
+        plan = self.plan_files()
+        if plan is None:
+            return None
+        to_localize, all_img_dict = plan
+        if all_img_dict:
+            url_queue.put_nowait((self.out_folder_path, dict(all_img_dict)))
+        loop = asyncio.get_event_loop()
+
+        async def localize(filename: str, local_paths: Dict[str, str]) -> None:
+            if self.metrics is None:
+                url_dict = await loop.run_in_executor(pool, localize_md_file, self.md_path, self.out_folder_path,
+                                                      filename, self.regex, local_paths, None, self.image_format,
+                                                      self.extract_data_uris)
+            else:
+                url_dict, stage_times = await loop.run_in_executor(
+                    pool, localize_md_file_timed, self.md_path, self.out_folder_path, filename, self.regex,
+                    local_paths, self.image_format, self.extract_data_uris)
+                self.metrics.add_stage_times(stage_times)
+            url_dict = self.add_localized(filename, url_dict)
+            add_to_img_dict(all_img_dict, url_dict)
+            if url_dict:
+                url_queue.put_nowait((self.out_folder_path, url_dict))
+
+        await asyncio.gather(*[localize(filename, local_paths) for filename, local_paths in to_localize])
+        self.finish_collect(all_img_dict)
+        return all_img_dict
+
+    def plan_files(self) -> Optional[Tuple[List[Tuple[str, Dict[str, str]]], Dict[str, Union[str, List[str]]]]]:
+        """
+        Decide what to do with this folder's markdown files, return the (filename, local paths to keep) of the files
+        to localize and the url dict of the images to download which are already known,
+        or None if there is nothing left to do (the saved dict was deleted by del_dict).
+        """
+        to_localize = []
         all_img_dict = {}  # dict that collect all images' urls and paths
+        self.manifest_images = []
         # 判断是否是 .assets 文件夹，如果是的话，则 all_img_dict 置为空
         # 如果不存在 all_img_dict.json 就说明在该文件夹是第一次运行，则读取所有文件并创建 all_img_dict.json
         if self.out_folder_path[-7:] == ".assets":
             all_img_dict = {}
+        elif self.manifest is not None:
+            # only the markdown files changed since the last run are localized again,
+            # and only the images which are not downloaded yet are returned (all of them when refreshing)
+            for filename in os.listdir(self.md_path):
+                if not filename.endswith(".md"):
+                    logging.info(f"Skipped file: {filename}\n")
+                    continue
+                md_file = os.path.join(self.md_path, filename)
+                if self.manifest.is_unchanged(md_file) and \
+                        os.path.exists(os.path.join(self.out_folder_path, filename)):
+                    logging.info(f"Unchanged file: {filename}\n")
+                    add_to_img_dict(all_img_dict, self.manifest_pending(md_file))
+                else:
+                    to_localize.append(
+                        (filename, self.manifest.get_local_paths(md_file)))
         elif not os.path.exists(os.path.join(self.out_folder_path, 'all_img_dict.json')):
             # Loop throught every markdown file on this script folder
             for filename in os.listdir(self.md_path):
                 if not filename.endswith(".md"):
                     logging.info(f"Skipped file: {filename}\n")
                     continue
-                # Open and read each file
-                file_data = open_and_read(os.path.join(self.md_path, filename))
-                # Create a dictionary of images URLs for each file
-                url_dict = create_url2local_dict(
-                    self.regex, file_data, filename)
-                # skip if no online link in this file
-                if url_dict:
-                    # Create a folder with md filename which contains images
-                    create_folder(os.path.join(
-                        self.out_folder_path, filename[:-3] + ".assets"))
-                    # Specify img folder
-                    url_dict = {key: os.path.join(
-                        filename[:-3] + ".assets", value) for key, value in url_dict.items()}
-                    # Edit the read content of each file, replacing the found imgs urls with local file names instead
-                    edited_file_data = file_replace_url(
-                        file_data, url_dict, filename)
-                    # Add url_dict to all_img_dict
-                    for key, value in url_dict.items():
-                        if key in all_img_dict and all_img_dict[key] != value:
-                            if not isinstance(all_img_dict[key], list):
-                                all_img_dict[key] = [all_img_dict[key]]
-                            if value not in all_img_dict[key]:
-                                all_img_dict[key].append(value)
-                        else:
-                            all_img_dict[key] = value
-                    # Write the modified markdown files
-                    write_file(self.out_folder_path,
-                               filename, edited_file_data)
-                else:
-                    logging.info(f"No url! Skipped file: {filename}\n")
-                logging.info(f"Closed file: {filename}\n")
-            write_image_url_json(self.out_folder_path, all_img_dict)
+                to_localize.append((filename, None))
         # 如果存在 all_img_dict.json 则直接使用其中的内容，也就是重复运行的情况下，仍能保证所有下载的文件名均相同，不会重复下载
         else:
-            if args.del_dict:
+            if self.del_dict:
                 logging.warning(
                     f"Deleting {os.path.join(self.out_folder_path,'all_img_dict.json')} ...")
                 delete_image_url_json(self.out_folder_path)
-                return
+                return None
             logging.warning(
                 "All_img_dict.json exists, will use the existed url dict.")
             all_img_dict = read_image_url_json(self.out_folder_path)
-        # Download the images listed on the dictionary of found urls for each file
-        loop = asyncio.get_event_loop()
-        loop.run_until_complete(
-            download(all_img_dict, self.out_folder_path, self.coroutine_num))
-        logging.warning(
-            f"\nFiles and the downloaded images on the folder:{self.out_folder_path}")
-        # 使用 noasync 的方式下载之前下载失败的图片
-        fail_dict = {}
-        logging.warning('Check and re-downloading fail images...')
-        for url, names in all_img_dict.items():
-            if isinstance(names, list):
-                for name in names:
-                    if not os.path.exists(os.path.join(self.out_folder_path, name)):
-                        fail_dict.update({url: name})
-            else:
-                if not os.path.exists(os.path.join(self.out_folder_path, names)):
-                    fail_dict.update({url: names})
-        download_images(fail_dict, self.out_folder_path, self.user_agent)
+        return to_localize, all_img_dict
+
+    def add_localized(self, filename: str, url_dict: Dict[str, str]) -> Dict[str, str]:
+        """
+        Record the url dict of a markdown file which has just been localized, and return the url dict to download
+        """
+        if self.manifest is None:
+            return url_dict
+        md_file = os.path.join(self.md_path, filename)
+        # the urls of a modified source file are already replaced by their local paths
+        if self.modify_source:
+            local_paths = self.manifest.get_local_paths(md_file)
+            local_paths.update(url_dict)
+            url_dict = local_paths
+        self.manifest.set_images(md_file, url_dict)
+        self.manifest.record_file(md_file)
+        return self.manifest_pending(md_file)
+
+    def manifest_pending(self, md_file: str) -> Dict[str, str]:
+        """
+        Return the url dict of the images of md_file to download according to the manifest: those not done,
+        or done but missing on disk (e.g. their .assets folder was deleted), and all of them when refreshing.
+        The folders of these images are created if needed.
+        """
+        url_dict = {}
+        for url, local_path, status in self.manifest.get_images(md_file):
+            img_path = os.path.join(self.out_folder_path, local_path)
+            if status != "done" or self.download_options.get("refresh") or not os.path.exists(img_path):
+                os.makedirs(os.path.dirname(img_path), exist_ok=True)
+                url_dict[url] = local_path
+                self.manifest_images.append((md_file, url, local_path))
+        return url_dict
+
+    def finish_collect(self, all_img_dict: Dict[str, Union[str, List[str]]]) -> None:
+        """Save what was collected: the manifest, or all_img_dict.json if the files were localized"""
+        if self.out_folder_path[-7:] == ".assets":
+            return
+        if self.manifest is not None:
+            self.manifest.commit()
+        elif not os.path.exists(os.path.join(self.out_folder_path, 'all_img_dict.json')):
+            write_image_url_json(self.out_folder_path, all_img_dict)
+
+    def localize_file(self, filename: str, local_paths: Dict[str, str] = None) -> Dict[str, str]:
+        """
+        Replace the image urls of one markdown file of this folder by local paths, write the new file
+        and return its url dict. The urls of local_paths keep the local path given there.
+        """
+        stage_times = self.metrics.stages if self.metrics is not None else None
+        return localize_md_file(self.md_path, self.out_folder_path, filename, self.regex, local_paths, stage_times,
+                                self.image_format, self.extract_data_uris)
 
+    def report_failed(self, all_img_dict: Dict[str, Union[str, List[str]]]) -> Dict[str, str]:
+        """
+        Report the images still missing after the download, and record the download status in the manifest.
+        Return the missing images, as a dict of url and path.
+        """
         # 打印最终未下载图片列表
-        fail_dict = {}
-        for url, names in all_img_dict.items():
-            if isinstance(names, list):
-                for name in names:
-                    if not os.path.exists(os.path.join(self.out_folder_path, name)):
-                        fail_dict.update({url: name})
-            else:
-                if not os.path.exists(os.path.join(self.out_folder_path, names)):
-                    fail_dict.update({url: names})
+        fail_dict = find_fail_dict(all_img_dict, self.out_folder_path)
         for url, name in fail_dict.items():
             logging.warning(f"Failed to download: {url}, Save as: {name}")
+        if self.manifest is not None:
+            for md_file, url, local_path in self.manifest_images:
+                done = os.path.exists(os.path.join(self.out_folder_path, local_path))
+                self.manifest.set_status(md_file, url, "done" if done else "failed")
+            self.manifest.commit()
+        return fail_dict
 
     @classmethod
-    def convert_absolute_to_relative(cls, md_path: str, img_folder: str) -> None:
+    def convert_absolute_to_relative(cls, md_path: str, img_folder: str) -> bool:
         """
-        Convert absolute image paths to relative paths in a single Markdown file.
+        Convert absolute image paths to relative paths in a single Markdown file, in one pass over its content.
+        The file is only written if a path was converted.
 
         Args:
         - md_path (str): Path to the Markdown file.
         - img_folder (str): Path to the image folder.
+
+        Returns:
+        - bool: True if the file was modified; False otherwise.
         """
         with open(md_path, 'r', encoding='utf-8') as md_file:
             md_content = md_file.read()
 
         regex_pattern = r"!\[.*?\]\((?P<path>.*?)\)"
-        matches = re.finditer(regex_pattern, md_content)
-
-        for match in matches:
+        md_dir = os.path.dirname(md_path)
+        parts = []
+        last = 0
+        for match in re.finditer(regex_pattern, md_content):
             absolute_path = match.group("path")
-
             if cls.is_local_image(absolute_path, img_folder):
-                relative_path = os.path.relpath(
-                    absolute_path, os.path.dirname(md_path))
-                md_content = md_content.replace(absolute_path, relative_path)
+                parts.append(md_content[last:match.start("path")])
+                parts.append(os.path.relpath(absolute_path, md_dir))
+                last = match.end("path")
+        if not parts:
+            return False
+        parts.append(md_content[last:])
+        new_content = "".join(parts)
+        if new_content == md_content:
+            return False
 
         with open(md_path, 'w', encoding='utf-8') as md_file:
-            md_file.write(md_content)
+            md_file.write(new_content)
+        return True
 
     @classmethod
     def is_local_image(cls, path: str, img_folder: str) -> bool:
@@ -337,34 +1391,359 @@ class MdImageLocal:
         return os.path.isabs(path) and path.startswith(img_folder)
 
     @classmethod
-    def convert_all_markdown_files_recursive(cls, folder_path: str) -> None:
-        for root, dirs, files in os.walk(folder_path):
-            for file_name in files:
-                if file_name.endswith(".md"):
-                    md_path = os.path.join(root, file_name)
-                    cls.convert_absolute_to_relative(md_path, folder_path)
-
-            for sub_dir in dirs:
-                cls.convert_all_markdown_files_recursive(
-                    os.path.join(root, sub_dir))
+    def convert_all_markdown_files_recursive(cls, folder_path: str, workers: int = 0) -> int:
+        """
+        Convert absolute image paths to relative paths in all Markdown files under folder_path,
+        each file once, in a pool of workers processes if workers > 0.
+        Return the number of modified files.
+        """
+        md_paths = [os.path.join(root, file_name)
+                    for root, _, files in os.walk(folder_path)
+                    for file_name in files if file_name.endswith(".md")]
+        if workers > 0 and len(md_paths) > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                modified = list(pool.map(cls.convert_absolute_to_relative, md_paths,
+                                         [folder_path] * len(md_paths),
+                                         chunksize=max(1, len(md_paths) // (workers * 4))))
+        else:
+            modified = [cls.convert_absolute_to_relative(md_path, folder_path) for md_path in md_paths]
+        logging.warning(f"Converted {sum(modified)} of {len(md_paths)} markdown files")
+        return sum(modified)
 
 
-def md_recursion(cur_path: str) -> None:
+def md_recursion(cur_path: str, manifest: Manifest = None, metrics: Metrics = None) -> None:
     """
     Recursively convert absolute image paths to relative paths in all Markdown files within a folder.
 
     Args:
     - folder_path (str): Path to the folder containing Markdown files.
+    - manifest (Manifest): Manifest shared by all folders, if any.
+    - metrics (Metrics): Metrics of the run, shared by all folders, if any.
     """
     filenames = os.listdir(cur_path)
     for filename in filenames:
         folder_path = os.path.join(cur_path, filename)
-        if os.path.isdir(folder_path):
-            md_recursion(folder_path)
+        if os.path.isdir(folder_path) and filename != STORE_FOLDER_NAME:
+            md_recursion(folder_path, manifest, metrics)
         elif filename.strip() == 'out':
             continue
     MdImageLocal(md_path=cur_path, log=args.log,
-                 modify_source=args.modify_source).run()
+                 modify_source=args.modify_source, dedup=args.dedup,
+                 download_options=download_options_from_args(args, metrics), manifest=manifest,
+                 workers=args.workers, del_dict=args.del_dict, extract_data_uris=args.extract_data_uris).run()
+
+
+def output_root(root_path: str, modify_source: bool) -> str:
+    """Return the output folder of root_path, where the files shared by the whole tree are kept"""
+    out_root = root_path if modify_source else os.path.join(root_path, "out")
+    create_folder(out_root)
+    return out_root
+
+
+def open_manifest(root_path: str, modify_source: bool) -> Manifest:
+    """Open (or create) the manifest of the tree under root_path, in its output folder"""
+    return Manifest(os.path.join(output_root(root_path, modify_source), MANIFEST_NAME), root_path)
+
+
+def tree_md_locals(root_path: str, **md_local_options) -> List[MdImageLocal]:
+    """Return an MdImageLocal (with md_local_options) for every folder of the tree holding source markdown files"""
+    md_locals = []
+    for cur_path, dirs, files in os.walk(root_path):
+        # output and image folders never contain source markdown files
+        dirs[:] = [d for d in dirs if is_source_folder(d)]
+        if not any(filename.endswith(".md") for filename in files):
+            continue
+        md_locals.append(MdImageLocal(md_path=cur_path, **md_local_options))
+    return md_locals
+
+
+def merge_img_dicts(md_locals: List[MdImageLocal],
+                    all_img_dicts: List[Optional[Dict[str, Union[str, List[str]]]]]) -> Dict[str, List[str]]:
+    """Merge the url dicts collected by md_locals into one dict of url -> list of absolute image paths"""
+    tree_img_dict = {}
+    for md_local, all_img_dict in zip(md_locals, all_img_dicts):
+        for url, names in (all_img_dict or {}).items():
+            names = names if isinstance(names, list) else [names]
+            paths = tree_img_dict.setdefault(url, [])
+            for name in names:
+                img_path = os.path.join(md_local.out_folder_path, name)
+                if img_path not in paths:
+                    paths.append(img_path)
+    return tree_img_dict
+
+
+def md_recursion_tree(root_path: str, coroutine_num: int = COROUTINE_NUM, dedup: bool = False,
+                      download_options: Dict = None, manifest: Manifest = None, workers: int = 0,
+                      modify_source: bool = False, del_dict: bool = False, extract_data_uris: bool = False) -> None:
+    """
+    Localize all Markdown files within a folder tree in one go.
+
+    Unlike md_recursion, which downloads folder by folder, every folder is scanned first and their url dicts are
+    merged into one tree-wide work queue, which is then downloaded through one shared session and event loop,
+    so that the connection pool is kept across folders and coroutine_num applies globally.
+
+    Args:
+    - root_path (str): Path to the root folder containing Markdown files.
+    - coroutine_num (int): Number of concurrent downloads for the whole tree.
+    - dedup (bool): Whether to keep one content-addressed store for the whole tree, in the root output folder.
+    - download_options (dict): Extra keyword arguments of download().
+    - manifest (Manifest): Manifest of the tree, if any, also used as the cache of the download validators.
+    - workers (int): Number of processes localizing the markdown files while the images are downloaded,
+      0 to localize all files first.
+    - modify_source (bool): Whether to modify the source markdown files instead of writing them to "out" folders.
+    - del_dict (bool): Whether to delete the saved all_img_dict.json files instead of downloading.
+    - extract_data_uris (bool): Whether to save the images embedded as base64 data uris in the .assets folders.
+    """
+    md_locals = tree_md_locals(root_path, modify_source=modify_source, dedup=dedup,
+                               download_options=download_options, manifest=manifest,
+                               del_dict=del_dict, extract_data_uris=extract_data_uris)
+    store = None
+    if dedup:
+        store = AssetStore(os.path.join(output_root(
+            root_path, modify_source), STORE_FOLDER_NAME))
+    loop = asyncio.get_event_loop()
+    if workers:
+        logging.warning(
+            f"Localizing {len(md_locals)} folders with {workers} workers while downloading...")
+        all_img_dicts = loop.run_until_complete(collect_and_download(
+            md_locals, workers, coroutine_num, store, cache=manifest, **(download_options or {})))
+    else:
+        all_img_dicts = [md_local.collect_img_dict() for md_local in md_locals]
+        tree_img_dict = merge_img_dicts(md_locals, all_img_dicts)
+        logging.warning(
+            f"Found {len(tree_img_dict)} image urls in {len(md_locals)} folders, downloading...")
+        # image paths are absolute, so they are not joined with the root folder
+        loop.run_until_complete(
+            download(tree_img_dict, root_path, coroutine_num, store,
+                     cache=manifest, **(download_options or {})))
+    for md_local, all_img_dict in zip(md_locals, all_img_dicts):
+        if all_img_dict is not None:
+            md_local.report_failed(all_img_dict)
+
+
+def plan_folder(root_path: str, modify_source: bool, plan_dir: str = None) -> str:
+    """Return the folder of the plan of the tree under root_path: plan_dir if given, else in its output folder"""
+    return plan_dir or os.path.join(output_root(root_path, modify_source), PLAN_FOLDER_NAME)
+
+
+def md_plan(root_path: str, shards: int, download_options: Dict = None, manifest: Manifest = None,
+            modify_source: bool = False, del_dict: bool = False, extract_data_uris: bool = False,
+            plan_dir: str = None) -> str:
+    """
+    Localize all Markdown files within a folder tree as md_recursion_tree does, but instead of downloading the images,
+    write the urls to download and their image paths (relative to root_path) to the plan folder, split into shards
+    by url hash, so that every shard can be downloaded by md_execute in its own process or machine.
+    Return the plan folder.
+
+    Args:
+    - root_path (str): Path to the root folder containing Markdown files.
+    - shards (int): Number of shards.
+    - download_options (dict): Extra keyword arguments of download(), only the image format is used here.
+    - manifest (Manifest): Manifest of the tree, if any, its validators are passed to the shards.
+    - modify_source (bool): Whether to modify the source markdown files instead of writing them to "out" folders.
+    - del_dict (bool): Whether to delete the saved all_img_dict.json files instead of planning.
+    - extract_data_uris (bool): Whether to save the images embedded as base64 data uris in the .assets folders.
+    - plan_dir (str): Folder of the plan, by default .plan in the root output folder.
+    """
+    plan_dir = plan_folder(root_path, modify_source, plan_dir)
+    md_locals = tree_md_locals(root_path, modify_source=modify_source, download_options=download_options,
+                               manifest=manifest, del_dict=del_dict, extract_data_uris=extract_data_uris)
+    tree_img_dict = merge_img_dicts(md_locals, [md_local.collect_img_dict() for md_local in md_locals])
+    img_dict = {url: [os.path.relpath(img_path, root_path) for img_path in img_paths]
+                for url, img_paths in tree_img_dict.items()}
+    validators = {}
+    if manifest is not None:
+        validators = {url: manifest.get_validators(url) for url in img_dict}
+    sizes = write_plan(plan_dir, img_dict, shards, validators)
+    logging.warning(f"Planned {len(img_dict)} image urls of {len(md_locals)} folders in {shards} shards "
+                    f"of {min(sizes)} to {max(sizes)} urls: {plan_dir}")
+    return plan_dir
+
+
+def md_execute(root_path: str, shard: int, shards: int, coroutine_num: int = COROUTINE_NUM, dedup: bool = False,
+               download_options: Dict = None, modify_source: bool = False,
+               plan_dir: str = None) -> Optional[Dict[str, str]]:
+    """
+    Download the images of the shard (1 to shards) of the plan written by md_plan, and write its result (the status
+    and the validators of every url) next to it for md_merge. The shards share nothing but the image folders
+    (and the store with dedup, whose blobs are added atomically), so they can run at the same time without
+    coordination, in several processes or on several machines sharing the tree.
+    Return the images of the shard which could not be downloaded, as a dict of url and path,
+    or None if the shard is not planned.
+    """
+    plan_dir = plan_folder(root_path, modify_source, plan_dir)
+    shard_data = read_json(shard_path(plan_dir, shard, shards))
+    if shard_data is None:
+        logging.error(f"No shard {shard}/{shards} in {plan_dir}, run --plan with --shards {shards} first")
+        return None
+    url_dict = {url: entry["paths"] for url, entry in shard_data["urls"].items()}
+    # the .assets folders may not exist yet on this machine
+    for folder in {os.path.dirname(os.path.join(root_path, path)) for paths in url_dict.values() for path in paths}:
+        os.makedirs(folder, exist_ok=True)
+    cache = ShardCache({url: entry["validators"] for url, entry in shard_data["urls"].items()
+                        if entry["validators"]})
+    store = AssetStore(os.path.join(output_root(
+        root_path, modify_source), STORE_FOLDER_NAME)) if dedup else None
+    logging.warning(f"Downloading {len(url_dict)} image urls of shard {shard}/{shards}...")
+    # image paths are relative to the root folder
+    asyncio.get_event_loop().run_until_complete(
+        download(url_dict, root_path, coroutine_num, store, cache=cache, **(download_options or {})))
+    fail_dict = {}
+    for url, paths in url_dict.items():
+        missing = [path for path in paths if not os.path.exists(os.path.join(root_path, path))]
+        if missing:
+            fail_dict[url] = missing[0]
+    write_json(result_path(plan_dir, shard, shards), {
+        "shard": shard, "shards": shards,
+        "statuses": {url: "failed" if url in fail_dict else "done" for url in url_dict},
+        "validators": cache.validators})
+    logging.warning(f"Shard {shard}/{shards}: {len(url_dict) - len(fail_dict)} downloaded, {len(fail_dict)} failed")
+    return fail_dict
+
+
+def md_merge(root_path: str, manifest: Manifest = None, modify_source: bool = False,
+             plan_dir: str = None) -> Optional[Dict[str, str]]:
+    """
+    Reconcile the results of the shards executed by md_execute: report the images still missing (also those of
+    the shards not executed yet), write them to failed.json in the plan folder, and record the download status
+    and the validators of the images in the manifest if any, as a run of the whole tree would.
+    Return the missing images, as a dict of url and path (relative to root_path), or None if there is no plan.
+    """
+    plan_dir = plan_folder(root_path, modify_source, plan_dir)
+    plan = read_json(os.path.join(plan_dir, PLAN_NAME))
+    if plan is None:
+        logging.error(f"No plan in {plan_dir}, run --plan first")
+        return None
+    shards = plan["shards"]
+    fail_dict = {}
+    for shard in range(1, shards + 1):
+        shard_data = read_json(shard_path(plan_dir, shard, shards))
+        result = read_json(result_path(plan_dir, shard, shards))
+        if result is None:
+            logging.warning(f"Shard {shard}/{shards} was not executed")
+        elif manifest is not None:
+            for url, validators in result["validators"].items():
+                manifest.set_validators(url, *validators)
+        # the images on disk are the truth, whatever the shards reported
+        for url, entry in shard_data["urls"].items():
+            missing = [path for path in entry["paths"] if not os.path.exists(os.path.join(root_path, path))]
+            if missing:
+                fail_dict[url] = missing[0]
+    for url, name in fail_dict.items():
+        logging.warning(f"Failed to download: {url}, Save as: {name}")
+    if manifest is not None:
+        for md_file, url, local_path, status in manifest.get_all_images():
+            md_path = os.path.dirname(md_file)
+            out_folder_path = md_path if modify_source else os.path.join(md_path, "out")
+            new_status = "done" if os.path.exists(os.path.join(out_folder_path, local_path)) else "failed"
+            if new_status != status:
+                manifest.set_status(md_file, url, new_status)
+        manifest.commit()
+    write_json(os.path.join(plan_dir, "failed.json"), fail_dict)
+    logging.warning(f"Merged {shards} shards of {plan['urls']} image urls: {len(fail_dict)} failed")
+    return fail_dict
+
+
+def saved_local_paths(out_folder_path: str, filename: str) -> Dict[str, str]:
+    """Return the url -> local path dict of the markdown file filename saved in the all_img_dict.json of its folder"""
+    if not os.path.exists(os.path.join(out_folder_path, 'all_img_dict.json')):
+        return {}
+    prefix = filename[:-3] + ".assets"
+    local_paths = {}
+    for url, names in read_image_url_json(out_folder_path).items():
+        for name in names if isinstance(names, list) else [names]:
+            if os.path.dirname(name) == prefix:
+                local_paths[url] = name
+    return local_paths
+
+
+def save_local_paths(out_folder_path: str, url_dict: Dict[str, str]) -> None:
+    """Add the url dict of a markdown file to the all_img_dict.json of its folder"""
+    all_img_dict = {}
+    if os.path.exists(os.path.join(out_folder_path, 'all_img_dict.json')):
+        all_img_dict = read_image_url_json(out_folder_path)
+    add_to_img_dict(all_img_dict, url_dict)
+    write_image_url_json(out_folder_path, all_img_dict)
+
+
+async def md_watch(root_path: str, coroutine_num: int = COROUTINE_NUM, dedup: bool = False,
+                   download_options: Dict = None, manifest: Manifest = None, modify_source: bool = False,
+                   debounce: float = DEBOUNCE, poll_interval: float = POLL_INTERVAL, poll: bool = False,
+                   extract_data_uris: bool = False) -> None:
+    """
+    Watch the Markdown files under a folder tree, and localize each file again as soon as it is created or modified
+    (see ChangeWatcher), until cancelled.
+
+    Only the changed files are read and rewritten. The urls already localized keep their local paths, taken from
+    the manifest, else from the url dicts of the files processed so far (the all_img_dict.json of their folder
+    at first), so that their images, already on disk, are not downloaded again.
+    All the downloads go through one session, kept open while watching.
+
+    Args:
+    - root_path (str): Path to the root folder containing Markdown files.
+    - coroutine_num (int): Number of concurrent downloads.
+    - dedup (bool): Whether to keep one content-addressed store for the whole tree, in the root output folder.
+    - download_options (dict): Extra keyword arguments of download().
+    - manifest (Manifest): Manifest of the tree, if any, also used as the cache of the download validators.
+    - modify_source (bool): Whether to modify the source markdown files instead of writing them to "out" folders.
+    - debounce (float): Seconds without changes before the changed files are processed.
+    - poll_interval (float): Seconds between two scans of the tree when inotify is not available.
+    - poll (bool): Whether to scan the tree even if inotify is available.
+    - extract_data_uris (bool): Whether to save the images embedded as base64 data uris in the .assets folders.
+    """
+    download_options = dict(download_options or {})
+    timeout = aiohttp.ClientTimeout(sock_connect=download_options.pop("connect_timeout", CONNECT_TIMEOUT),
+                                    sock_read=download_options.pop("read_timeout", READ_TIMEOUT))
+    image_format = (download_options.get("optimize") or {}).get("image_format")
+    store = AssetStore(os.path.join(output_root(
+        root_path, modify_source), STORE_FOLDER_NAME)) if dedup else None
+    url_dicts = {}  # markdown file -> url dict of its last localization
+    async with aiohttp.ClientSession(timeout=timeout, headers={"User-Agent": USER_AGENT}) as session:
+        async for md_files in ChangeWatcher(root_path, debounce, poll_interval, poll).batches():
+            batch_img_dict = {}  # url -> list of absolute image paths, over the changed files
+            localized = []  # (markdown file, output folder, url dict)
+            for md_file in sorted(md_files):
+                # a file rewritten by the last batch (with modify_source) is recorded as unchanged in the manifest
+                if not os.path.exists(md_file) or manifest is not None and manifest.is_unchanged(md_file):
+                    continue
+                md_path, filename = os.path.split(md_file)
+                out_folder_path = os.path.abspath(md_path if modify_source else os.path.join(md_path, "out"))
+                create_folder(out_folder_path)
+                if manifest is not None:
+                    local_paths = manifest.get_local_paths(md_file)
+                elif md_file in url_dicts:
+                    local_paths = url_dicts[md_file]
+                else:
+                    local_paths = saved_local_paths(out_folder_path, filename)
+                url_dict = localize_md_file(md_path, out_folder_path, filename, None, local_paths,
+                                            image_format=image_format, extract_data_uris=extract_data_uris)
+                # the urls of a modified source file are already replaced by their local paths
+                if modify_source:
+                    url_dict = dict(local_paths, **url_dict)
+                url_dicts[md_file] = url_dict
+                if manifest is not None:
+                    manifest.set_images(md_file, url_dict)
+                    manifest.record_file(md_file)
+                elif url_dict:
+                    save_local_paths(out_folder_path, url_dict)
+                localized.append((md_file, out_folder_path, url_dict))
+                for url, name in url_dict.items():
+                    batch_img_dict.setdefault(url, []).append(os.path.join(out_folder_path, name))
+            if not localized:
+                continue
+            logging.warning(f"Localized {len(localized)} changed files, downloading {len(batch_img_dict)} images...")
+            # image paths are absolute, so they are not joined with the root folder
+            await download(batch_img_dict, root_path, coroutine_num, store, cache=manifest,
+                           session=session, **download_options)
+            for md_file, out_folder_path, url_dict in localized:
+                fail_dict = find_fail_dict(url_dict, out_folder_path)
+                for url, name in fail_dict.items():
+                    logging.warning(f"Failed to download: {url}, Save as: {name}")
+                if manifest is not None:
+                    for url in url_dict:
+                        manifest.set_status(md_file, url, "failed" if url in fail_dict else "done")
+            if manifest is not None:
+                manifest.commit()
 
 
 def test_MdImageLocal():
@@ -415,6 +1794,183 @@ def test_MdImageLocal():
     logging.warning("All tests passed in test_folder.")
 
 
+def test_find_url_spans():
+    """
+    离线测试链接提取：默认的线性扫描器须与REGEX_PATTERN找到相同的链接和相同的结尾(本地文件名)，
+    包括test_case中的文件，以及微信公众号(mmbiz_)、带?和#参数的链接和<img>标签
+    """
+    logging.warning("Test the scanner against REGEX_PATTERN\n")
+    # url -> its local name, without the random characters it starts with
+    expected_names = {
+        "https://mmbiz.qpic.cn/mmbiz_png/AbCdEf123/640?wx_fmt=png&wxfrom=5": "AbCdEf123.png",
+        "https://mmbiz.qpic.cn/mmbiz_jpg/XyZ987/0?wx_fmt=jpeg": "0",
+        "https://example.com/img/photo.jpg?width=800&height=600": "photo.jpg",
+        "https://example.com/img/diagram.svg#section-2": "diagram.svg",
+        "https://example.com/a/b/pic.gif?v=3#top": "pic.gif",
+        "https://example.com/avatar/12345": "12345",
+        "https://example.com/1.png": "1.png",
+        "https://example.com/2.jpeg": "2.jpeg",
+        "https://example.com/tag/one.png": ".png",
+        "https://mmbiz.qpic.cn/mmbiz_png/Tag42/640?wx_fmt=png": "Tag42.png",
+        "https://example.com/tag/two.webp?x-oss-process=image%2Fresize": "size",
+    }
+    lines = "\n\n".join([
+        "![微信](https://mmbiz.qpic.cn/mmbiz_png/AbCdEf123/640?wx_fmt=png&wxfrom=5)",
+        "![jpg](https://mmbiz.qpic.cn/mmbiz_jpg/XyZ987/0?wx_fmt=jpeg)",
+        "![q](https://example.com/img/photo.jpg?width=800&height=600)",
+        "![h](https://example.com/img/diagram.svg#section-2)",
+        "![qh](https://example.com/a/b/pic.gif?v=3#top)",
+        "![noext](https://example.com/avatar/12345)",
+        "two on a line ![a](https://example.com/1.png) and ![b](https://example.com/2.jpeg) end",
+        '<img src="https://example.com/tag/one.png" width="600">',
+        '<img src="https://mmbiz.qpic.cn/mmbiz_png/Tag42/640?wx_fmt=png" alt="x">',
+        '<img alt="q" src="https://example.com/tag/two.webp?x-oss-process=image%2Fresize">',
+        "![dup](https://example.com/1.png)",
+    ])
+    texts = {"lines": lines}
+    for root, _, files in os.walk("./test_case"):
+        for name in files:
+            if name.endswith(".md"):
+                texts[os.path.join(root, name)] = open_and_read(os.path.join(root, name))
+    for name, text in texts.items():
+        url_spans = find_url_spans(None, text)
+        assert url_spans == find_url_spans(REGEX_PATTERN, text), f"{name}: the scanner differs from REGEX_PATTERN"
+    names = {url: path[10:] for url, path in create_url2local_dict(None, lines, "test.md").items()}
+    assert names == expected_names, names
+    logging.warning("All tests passed in find_url_spans.")
+
+
+def test_localize_md_stream():
+    """
+    离线测试分块处理：跨越块边界的链接、跨越多个块的data uri，在20 KB和50 KB的块下
+    结果须与整体处理(localize_md_text)一致，提取出的图片须与原图逐字节相同
+    """
+    logging.warning("Test localize_md_stream with 20 KB and 50 KB chunks\n")
+    filename = "stream.md"
+    chunk_sizes = (20 * 1024, 50 * 1024)
+    rng = random.Random(0)
+    images = [rng.getrandbits(8 * size).to_bytes(size, "little") for size in (90 * 1024, 3, 40 * 1024)]
+    payloads = [base64.b64encode(image).decode("ascii") for image in images]
+    links = ['![a{0}](http://example.com/a{0}.png)', '![b {0}](https://example.com/b{0}.jpg "title")',
+             '<img src="http://example.com/c{0}.gif">', '![d{0}](<http://example.com/d {0}.png>)']
+    data_uris = ['![e{0}](data:image/png;base64,{1})', '<img alt="f{0}" src="data:image/jpeg;base64,{1}">']
+    # a link crosses every chunk boundary, the data uris (one of them twice) span several chunks
+    text = ""
+    i = 0
+    for boundary in sorted({k * size for size in chunk_sizes for k in range(1, 9)}):
+        while len(text) < boundary - 2000:
+            i += 1
+            text += rng.choice(links).format(i) + " lorem ipsum" * rng.randint(0, 20) + rng.choice(["", "\n"])
+            if i % 400 == 0:
+                text += rng.choice(data_uris).format(i, payloads[i // 400 % len(payloads)])
+        link = rng.choice(links).format(boundary)
+        if len(text) < boundary - len(link):
+            text += "x" * (boundary - rng.randint(1, len(link) - 1) - len(text)) + link
+
+    folder = tempfile.mkdtemp()
+    try:
+        whole_folder = os.path.join(folder, "whole")
+        expected, url_dict = localize_md_text(text, filename, None)
+        extracted_text, extracted = extract_md_data_uris(text, filename, whole_folder)
+        expected_extracted, extracted_url_dict = localize_md_text(extracted_text, filename, None)
+        assert extracted == text.count(";base64,") and sorted(
+            open(os.path.join(whole_folder, name), "rb").read() for name in os.listdir(whole_folder)) == sorted(images)
+        for chunk_size in chunk_sizes:
+            # the local names are random, the stream gets those of the whole text
+            writer, stream_url_dict = io.StringIO(), {}
+            localize_md_stream(io.StringIO(text), writer, filename, folder, stream_url_dict, url_dict,
+                               chunk_size=chunk_size)
+            assert writer.getvalue() == expected and stream_url_dict == url_dict, f"chunk size {chunk_size}"
+
+            chunk_folder = os.path.join(folder, str(chunk_size))
+            writer, stream_url_dict = io.StringIO(), {}
+            assert localize_md_stream(io.StringIO(text), writer, filename, chunk_folder, stream_url_dict,
+                                      extracted_url_dict, extract_data_uris=True, chunk_size=chunk_size) == extracted
+            assert writer.getvalue() == expected_extracted and stream_url_dict == extracted_url_dict, \
+                f"chunk size {chunk_size} with data uris"
+            assert sorted(os.listdir(chunk_folder)) == sorted(os.listdir(whole_folder))
+            for name in os.listdir(chunk_folder):
+                with open(os.path.join(chunk_folder, name), "rb") as f, \
+                        open(os.path.join(whole_folder, name), "rb") as whole_f:
+                    assert f.read() == whole_f.read(), f"chunk size {chunk_size}: {name} differs"
+    finally:
+        delete_folder(folder)
+    logging.warning("All tests passed in localize_md_stream.")
+
+
+def test_resume():
+    """
+    离线测试断点续传：本地服务器第一次只发送一半图片，停顿到客户端读取超时后断开连接，下一次运行须以Range和If-Range
+    只请求剩下的部分，得到与原图逐字节相同的图片，分别测试普通下载和--dedup
+    """
+    from aiohttp import web
+
+    logging.warning("Test resuming interrupted downloads\n")
+    image = random.Random(0).getrandbits(8 * 300 * 1024).to_bytes(300 * 1024, "little")
+    etag = '"v1"'
+    requests = []  # the headers of the requests to the server
+    dropped = set()  # the images whose first response was cut
+    read_timeout = 0.5
+
+    async def serve_image(request):
+        requests.append(request.headers)
+        m = re.match(r"bytes=(\d+)-$", request.headers.get("Range", ""))
+        if m and request.headers.get("If-Range") == etag:
+            start = int(m.group(1))
+            return web.Response(status=206, body=image[start:], headers={
+                "ETag": etag, "Accept-Ranges": "bytes",
+                "Content-Range": f"bytes {start}-{len(image) - 1}/{len(image)}"})
+        response = web.StreamResponse(headers={"ETag": etag, "Accept-Ranges": "bytes"})
+        response.content_length = len(image)
+        await response.prepare(request)
+        if request.path in dropped:
+            await response.write(image)
+        else:
+            dropped.add(request.path)
+            await response.write(image[:len(image) // 2])
+            # the client reads what was sent and times out, then the connection is dropped
+            await asyncio.sleep(2 * read_timeout)
+            if request.transport is not None:
+                request.transport.close()
+        return response
+
+    async def run_test(folder):
+        app = web.Application()
+        app.router.add_get("/img/{name}", serve_image)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        try:
+            await web.TCPSite(runner, "127.0.0.1", 0).start()
+            port = runner.addresses[0][1]
+            for dedup in (False, True):
+                url = f"http://127.0.0.1:{port}/img/{'dedup' if dedup else 'plain'}.png"
+                img_path = os.path.join(folder, f"{dedup}.png")
+                store = AssetStore(os.path.join(folder, STORE_FOLDER_NAME)) if dedup else None
+                part_path = store.part_path(url) if dedup else img_path + PART_SUFFIX
+                await download({url: f"{dedup}.png"}, folder, 1, store, retries=0, read_timeout=read_timeout)
+                assert not os.path.exists(img_path) and 0 < os.path.getsize(part_path) < len(image), \
+                    f"dedup {dedup}: the interrupted download is not kept"
+                assert "Range" not in requests[-1]
+                offset = os.path.getsize(part_path)
+                await download({url: f"{dedup}.png"}, folder, 1, store, retries=0, read_timeout=read_timeout)
+                assert requests[-1].get("Range") == f"bytes={offset}-" and requests[-1].get("If-Range") == etag, \
+                    f"dedup {dedup}: not resumed with Range and If-Range"
+                with open(img_path, "rb") as f:
+                    assert f.read() == image, f"dedup {dedup}: the resumed image differs"
+                assert not os.path.exists(part_path) and not os.path.exists(part_path + ".json")
+                if dedup:
+                    assert os.path.exists(store.blob_path(hashlib.sha256(image).hexdigest()))
+        finally:
+            await runner.cleanup()
+
+    folder = tempfile.mkdtemp()
+    try:
+        asyncio.get_event_loop().run_until_complete(run_test(folder))
+    finally:
+        delete_folder(folder)
+    logging.warning("All tests passed in resume.")
+
+
 if __name__ == "__main__":
     time0 = time.time()
     args = parse_args()
@@ -425,6 +1981,9 @@ if __name__ == "__main__":
 
     # Check args
     if args.test:
+        test_find_url_spans()
+        test_localize_md_stream()
+        test_resume()
         test_MdImageLocal()
         sys.exit(0)
     if not args.md_path:
@@ -432,10 +1991,45 @@ if __name__ == "__main__":
         md_recursion(md_path_input)
     if args.relative:
         logging.warning("Converting to relative path...")
-        MdImageLocal.convert_all_markdown_files_recursive(args.md_path)
+        MdImageLocal.convert_all_markdown_files_recursive(args.md_path, args.workers)
         sys.exit(0)
     # Set coroutine_num
     COROUTINE_NUM = args.coroutine_num
+    LOG_LINKS = args.log_links
+    if (args.optimize or args.max_dimension or args.image_format) and not PILLOW_AVAILABLE:
+        logging.error("Optimizing images needs Pillow: pip install pillow")
+        sys.exit(1)
     logging.warning(f'Using {COROUTINE_NUM} coroutine...')
-    md_recursion(args.md_path)
+    metrics = Metrics(args.progress) if args.metrics_out or args.progress else None
+    # the shards do not write to the manifest, so that they can run at the same time
+    manifest = open_manifest(
+        args.md_path, args.modify_source) if (args.manifest or args.refresh) and not args.shard else None
+    if args.plan:
+        md_plan(args.md_path, args.shards, download_options_from_args(args, metrics), manifest,
+                args.modify_source, args.del_dict, args.extract_data_uris, args.plan_dir)
+    elif args.shard:
+        md_execute(args.md_path, args.shard[0], args.shard[1], COROUTINE_NUM, args.dedup,
+                   download_options_from_args(args, metrics), args.modify_source, args.plan_dir)
+    elif args.merge:
+        md_merge(args.md_path, manifest, args.modify_source, args.plan_dir)
+    elif args.tree_wide:
+        md_recursion_tree(args.md_path, COROUTINE_NUM, args.dedup,
+                          download_options_from_args(args, metrics), manifest, args.workers,
+                          args.modify_source, args.del_dict, args.extract_data_uris)
+    else:
+        md_recursion(args.md_path, manifest, metrics)
+    if args.watch:
+        try:
+            asyncio.get_event_loop().run_until_complete(md_watch(
+                args.md_path, COROUTINE_NUM, args.dedup, download_options_from_args(args, metrics), manifest,
+                args.modify_source, args.debounce, args.poll_interval, args.poll, args.extract_data_uris))
+        except KeyboardInterrupt:
+            logging.warning("Stopped watching")
+    if manifest is not None:
+        manifest.close()
+    if metrics is not None and metrics.progress:
+        metrics.show_progress(final=True)
+    if args.metrics_out:
+        metrics.write(args.metrics_out)
+        logging.warning(f"Metrics written to {args.metrics_out}")
     logging.warning(f"Time consumed:{time.time() - time0}")
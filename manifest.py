@@ -0,0 +1,139 @@
+# manifest.py
+import hashlib
+import logging
+import os
+import sqlite3
+from typing import Dict, List, Optional, Tuple
+
+MANIFEST_NAME = "manifest.sqlite3"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime REAL NOT NULL,
+    sha256 TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS images (
+    file TEXT NOT NULL,
+    url TEXT NOT NULL,
+    local_path TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    PRIMARY KEY (file, url)
+);
+CREATE TABLE IF NOT EXISTS http_cache (
+    url TEXT PRIMARY KEY,
+    etag TEXT,
+    last_modified TEXT,
+    content_length INTEGER
+);
+"""
+
+
+def file_sha256(file_path: str) -> str:
+    """Return the sha256 of the content of file_path"""
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class Manifest:
+    """
+    Persistent record, kept in SQLite, of the markdown files under md_root (size, mtime and content hash),
+    the image urls found in each of them, the local paths assigned to these urls and their download status,
+    and the HTTP validators (ETag, Last-Modified, Content-Length) of the downloaded urls.
+    It lets a re-run parse only the changed markdown files and download only the new or failed images.
+    Paths are saved relative to md_root, local paths as written in the markdown file.
+    """
+
+    def __init__(self, db_path: str, md_root: str) -> None:
+        self.db_path = db_path
+        self.md_root = os.path.abspath(md_root)
+        # used from the thread pool of the event loop too (see MdImageLocal.run_async), never by two threads at once
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.executescript(SCHEMA)
+        logging.info(f"Opened manifest: {db_path}")
+
+    def key(self, file_path: str) -> str:
+        return os.path.relpath(os.path.abspath(file_path), self.md_root)
+
+    def is_unchanged(self, file_path: str) -> bool:
+        """
+        Whether file_path is the same as when it was recorded: same size and mtime,
+        or else same content hash (the new mtime is then recorded).
+        """
+        row = self.conn.execute("SELECT size, mtime, sha256 FROM files WHERE path = ?",
+                                (self.key(file_path),)).fetchone()
+        if row is None:
+            return False
+        stat = os.stat(file_path)
+        if (stat.st_size, stat.st_mtime) == (row[0], row[1]):
+            return True
+        if stat.st_size != row[0] or file_sha256(file_path) != row[2]:
+            return False
+        self.conn.execute("UPDATE files SET mtime = ? WHERE path = ?",
+                          (stat.st_mtime, self.key(file_path)))
+        return True
+
+    def record_file(self, file_path: str) -> None:
+        """Record the current size, mtime and content hash of file_path"""
+        stat = os.stat(file_path)
+        self.conn.execute("INSERT OR REPLACE INTO files (path, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+                          (self.key(file_path), stat.st_size, stat.st_mtime, file_sha256(file_path)))
+
+    def get_images(self, file_path: str) -> List[Tuple[str, str, str]]:
+        """Return the (url, local_path, status) of the images recorded for file_path"""
+        return self.conn.execute("SELECT url, local_path, status FROM images WHERE file = ?",
+                                 (self.key(file_path),)).fetchall()
+
+    def get_all_images(self) -> List[Tuple[str, str, str, str]]:
+        """Return the (file path, url, local_path, status) of the images recorded for all files"""
+        return [(os.path.join(self.md_root, key), url, local_path, status) for key, url, local_path, status in
+                self.conn.execute("SELECT file, url, local_path, status FROM images").fetchall()]
+
+    def get_local_paths(self, file_path: str) -> Dict[str, str]:
+        """Return the url -> local path dict recorded for file_path"""
+        return {url: local_path for url, local_path, _ in self.get_images(file_path)}
+
+    def set_images(self, file_path: str, url_dict: Dict[str, str]) -> None:
+        """
+        Replace the images recorded for file_path by url_dict (url -> local path),
+        keeping the status of the urls whose local path did not change.
+        """
+        key = self.key(file_path)
+        old_images = {url: (local_path, status)
+                      for url, local_path, status in self.get_images(file_path)}
+        self.conn.execute("DELETE FROM images WHERE file = ?", (key,))
+        self.conn.executemany(
+            "INSERT INTO images (file, url, local_path, status) VALUES (?, ?, ?, ?)",
+            [(key, url, local_path,
+              old_images[url][1] if old_images.get(url, (None,))[0] == local_path else "pending")
+             for url, local_path in url_dict.items()])
+
+    def set_status(self, file_path: str, url: str, status: str) -> None:
+        self.conn.execute("UPDATE images SET status = ? WHERE file = ? AND url = ?",
+                          (status, self.key(file_path), url))
+
+    def get_status(self, file_path: str, url: str) -> Optional[str]:
+        row = self.conn.execute("SELECT status FROM images WHERE file = ? AND url = ?",
+                                (self.key(file_path), url)).fetchone()
+        return row[0] if row else None
+
+    def get_validators(self, url: str) -> Optional[Tuple[Optional[str], Optional[str], Optional[int]]]:
+        """Return the (ETag, Last-Modified, Content-Length) of the last download of url, if any"""
+        return self.conn.execute("SELECT etag, last_modified, content_length FROM http_cache WHERE url = ?",
+                                 (url,)).fetchone()
+
+    def set_validators(self, url: str, etag: Optional[str], last_modified: Optional[str],
+                       content_length: Optional[int]) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO http_cache (url, etag, last_modified, content_length) "
+                          "VALUES (?, ?, ?, ?)", (url, etag, last_modified, content_length))
+
+    def commit(self) -> None:
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
@@ -0,0 +1,152 @@
+# metrics.py
+import csv
+import json
+import sys
+import time
+import urllib.parse
+from typing import Dict, List
+
+# upper bounds (seconds) of the buckets of the latency histograms, the last bucket counts the longer requests
+LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROGRESS_INTERVAL = 0.5  # seconds between two updates of the progress line
+
+
+class HostMetrics:
+    """Requests, bytes and latency histogram of the downloads from one host"""
+
+    def __init__(self) -> None:
+        self.requests = 0
+        self.statuses = {}  # outcome of the requests -> count
+        self.bytes = 0
+        self.latency_sum = 0.0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.concurrency_limit = None  # final and max limits of the host in adaptive mode
+        self.max_concurrency_limit = None
+
+    def add_request(self, outcome: str, latency: float) -> None:
+        self.requests += 1
+        self.statuses[outcome] = self.statuses.get(outcome, 0) + 1
+        self.latency_sum += latency
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if latency <= bound:
+                self.latency_buckets[i] += 1
+                break
+        else:
+            self.latency_buckets[-1] += 1
+
+    def histogram(self) -> Dict[str, int]:
+        labels = [f"le_{bound}" for bound in LATENCY_BUCKETS] + [f"gt_{LATENCY_BUCKETS[-1]}"]
+        return dict(zip(labels, self.latency_buckets))
+
+    def to_dict(self) -> Dict:
+        return {
+            "requests": self.requests,
+            "statuses": self.statuses,
+            "bytes": self.bytes,
+            "latency_mean_s": self.latency_sum / self.requests if self.requests else None,
+            "latency_histogram_s": self.histogram(),
+            "concurrency_limit": self.concurrency_limit,
+            "max_concurrency_limit": self.max_concurrency_limit,
+        }
+
+
+class Metrics:
+    """
+    Metrics of a whole run, shared by all folders: time spent in each stage, requests, bytes and latencies
+    of each host, counters (downloaded, failed, retried...) and the time spent waiting for a download slot.
+    The stage times of parallel work (parsing in several processes, concurrent downloads) are summed.
+    If progress is True, a progress line is kept up to date on stderr.
+    """
+
+    def __init__(self, progress: bool = False) -> None:
+        self.start = time.perf_counter()
+        self.stages = {}  # stage -> seconds
+        self.hosts = {}  # host -> HostMetrics
+        self.counters = {}
+        self.semaphore_wait = {"count": 0, "total_s": 0.0, "max_s": 0.0}
+        self.progress = progress
+        self.last_progress = 0.0
+
+    def add_time(self, stage: str, seconds: float) -> None:
+        self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+    def add_stage_times(self, stage_times: Dict[str, float]) -> None:
+        for stage, seconds in stage_times.items():
+            self.add_time(stage, seconds)
+
+    def count(self, counter: str, n: int = 1) -> None:
+        self.counters[counter] = self.counters.get(counter, 0) + n
+        if self.progress:
+            self.show_progress()
+
+    def host(self, url: str) -> HostMetrics:
+        return self.host_named(urllib.parse.urlsplit(url).netloc)
+
+    def host_named(self, host: str) -> HostMetrics:
+        if host not in self.hosts:
+            self.hosts[host] = HostMetrics()
+        return self.hosts[host]
+
+    def set_concurrency_limit(self, host: str, limit: int, max_limit: int) -> None:
+        host_metrics = self.host_named(host)
+        host_metrics.concurrency_limit = limit
+        host_metrics.max_concurrency_limit = max(max_limit, host_metrics.max_concurrency_limit or 0)
+
+    def add_request(self, url: str, outcome: str, latency: float) -> None:
+        self.host(url).add_request(outcome, latency)
+
+    def add_bytes(self, url: str, n: int) -> None:
+        self.host(url).bytes += n
+
+    def add_wait(self, seconds: float) -> None:
+        self.semaphore_wait["count"] += 1
+        self.semaphore_wait["total_s"] += seconds
+        self.semaphore_wait["max_s"] = max(self.semaphore_wait["max_s"], seconds)
+
+    def show_progress(self, final: bool = False) -> None:
+        now = time.perf_counter()
+        if not final and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        done = sum(self.counters.get(counter, 0) for counter in ("downloaded", "revalidated", "failed", "skipped"))
+        megabytes = sum(host.bytes for host in self.hosts.values()) / 1024 / 1024
+        elapsed = now - self.start
+        sys.stderr.write(f"\rimages: {done}/{self.counters.get('queued', 0)}, "
+                         f"failed: {self.counters.get('failed', 0)}, retried: {self.counters.get('retried', 0)}, "
+                         f"{megabytes:.1f} MB, {megabytes / elapsed if elapsed else 0:.2f} MB/s"
+                         + ("\n" if final else ""))
+        sys.stderr.flush()
+
+    def to_dict(self) -> Dict:
+        return {
+            "elapsed_s": time.perf_counter() - self.start,
+            "stages_s": self.stages,
+            "counters": self.counters,
+            "semaphore_wait": self.semaphore_wait,
+            "hosts": {host: host_metrics.to_dict() for host, host_metrics in self.hosts.items()},
+        }
+
+    def rows(self) -> List[List]:
+        """The metrics as (section, name, key, value) rows"""
+        report = self.to_dict()
+        rows = [["run", "", "elapsed_s", report["elapsed_s"]]]
+        rows += [["stage", stage, "seconds", seconds] for stage, seconds in report["stages_s"].items()]
+        rows += [["counter", counter, "count", n] for counter, n in report["counters"].items()]
+        rows += [["semaphore_wait", "", key, value] for key, value in report["semaphore_wait"].items()]
+        for host, host_metrics in report["hosts"].items():
+            for key, value in host_metrics.items():
+                if isinstance(value, dict):
+                    rows += [["host", host, f"{key}.{sub_key}", sub_value] for sub_key, sub_value in value.items()]
+                else:
+                    rows.append(["host", host, key, value])
+        return rows
+
+    def write(self, path: str) -> None:
+        """Write the metrics to path, as CSV if it ends with .csv, else as JSON"""
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            if path.lower().endswith(".csv"):
+                writer = csv.writer(f)
+                writer.writerow(["section", "name", "key", "value"])
+                writer.writerows(self.rows())
+            else:
+                json.dump(self.to_dict(), f, indent=2)
@@ -0,0 +1,97 @@
+# optimize.py
+import logging
+import os
+import shutil
+import subprocess
+from typing import Optional, Tuple
+
+# Pillow is only needed by --optimize
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PILLOW_AVAILABLE = Image is not None
+
+# extensions of the images which can be recompressed or converted, and their Pillow format
+FORMATS = {".png": "PNG", ".jpg": "JPEG", ".jpeg": "JPEG", ".webp": "WEBP", ".bmp": "BMP", ".tif": "TIFF",
+           ".tiff": "TIFF"}
+
+
+def converted_name(name: str, image_format: Optional[str]) -> str:
+    """The name of an image once converted to image_format (an extension such as "webp"), if it can be converted"""
+    root, ext = os.path.splitext(name)
+    if not image_format or ext.lower() not in FORMATS:
+        return name
+    return root + "." + image_format.lower()
+
+
+def save_options(image_format: str) -> dict:
+    """Options of Image.save for the smallest file without losing quality"""
+    if image_format == "PNG":
+        return {"optimize": True}
+    if image_format == "JPEG":
+        return {"optimize": True, "progressive": True}
+    if image_format == "WEBP":
+        return {"lossless": True, "method": 6}
+    return {}
+
+
+def recompress_jpeg(file_path: str, tmp_path: str) -> bool:
+    """
+    Recompress a JPEG without decoding it with jpegtran (optimized Huffman tables, progressive), if it is installed:
+    re-encoding it with Pillow would change its pixels. Return whether tmp_path was written.
+    """
+    jpegtran = shutil.which("jpegtran")
+    if jpegtran is None:
+        return False
+    result = subprocess.run([jpegtran, "-copy", "none", "-optimize", "-progressive", "-outfile", tmp_path, file_path],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return result.returncode == 0
+
+
+def optimize_image(file_path: str, ext: str, max_dimension: int = None, convert: bool = False) -> Tuple[int, int]:
+    """
+    Recompress the image file_path without loss (JPEG images only with jpegtran), and downscale it so that its sides
+    are at most max_dimension if given. It keeps the format it was served in, which may differ from its extension,
+    unless convert is True: it is then saved in the format of the extension ext (the extension it is saved as
+    in the markdown file, see converted_name).
+    The optimized image only replaces file_path if it is smaller, or if the format or the size changed.
+    An image which can not be optimized (e.g. too large to decode, see Image.MAX_IMAGE_PIXELS) is kept as it is.
+    Return the sizes of the file before and after.
+    This is a module level function so that it can run in a process pool.
+    """
+    size_before = os.path.getsize(file_path)
+    if Image is None:
+        return size_before, size_before
+    tmp_path = file_path + ".opt"
+    try:
+        with Image.open(file_path) as image:
+            if getattr(image, "is_animated", False):
+                # the other frames would be lost
+                return size_before, size_before
+            image_format = (FORMATS.get(ext.lower()) if convert else None) or image.format
+            if image_format not in FORMATS.values():
+                return size_before, size_before
+            changed = image.format != image_format
+            if max_dimension and max(image.size) > max_dimension:
+                image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+                changed = True
+            if image_format == "JPEG" and not changed:
+                if not recompress_jpeg(file_path, tmp_path):
+                    return size_before, size_before
+            else:
+                if image_format == "JPEG" and image.mode not in ("RGB", "L", "CMYK"):
+                    image = image.convert("RGB")
+                image.save(tmp_path, image_format, **save_options(image_format))
+        size_after = os.path.getsize(tmp_path)
+        if changed or size_after < size_before:
+            os.replace(tmp_path, file_path)
+            return size_before, size_after
+    except Exception as e:
+        # Pillow raises DecompressionBombError (not an OSError) for images with too many pixels, and other errors
+        # for broken images
+        logging.warning(f"Could not optimize {file_path}: {e}")
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    return size_before, size_before
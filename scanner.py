@@ -0,0 +1,183 @@
+# scanner.py
+import re
+from typing import List, Pattern, Tuple
+
+MAX_ALT_LENGTH = 1024  # characters of alt text (or reference label) looked at after "!["
+MAX_URL_LENGTH = 8192  # characters of url looked at in a link or a src attribute
+# characters from the start of a link to the end of its url (but for urls with many parentheses),
+# a text cut that far after a link start contains the whole link
+MAX_LINK_LENGTH = 2 * MAX_ALT_LENGTH + 2 * MAX_URL_LENGTH + 64
+
+# Every construct starts at one of these triggers, so the text is searched only once for them.
+# The patterns below are matched at a trigger, they have no nested quantifiers and bounded repetitions,
+# so that the work done at a trigger is bounded whatever the text contains (unbalanced brackets, long lines...).
+TRIGGER_REGEX = re.compile(r"!\[|<img\b", re.IGNORECASE)
+# inline destination: (url), (<url>), (url "title"), with balanced parentheses in the url
+DESTINATION_REGEX = re.compile(
+    r"""\([ \t]*(?:<(?P<bracketed>[^<>\n]{1,%d})>|(?P<url>(?:[^\s()]|\([^\s()]{0,%d}\)){1,%d}))"""
+    r"""(?:[ \t]+(?:"[^"\n]{0,%d}"|'[^'\n]{0,%d}'|\([^()\n]{0,%d}\)))?[ \t]*\)"""
+    % ((MAX_URL_LENGTH,) * 3 + (MAX_ALT_LENGTH,) * 3))
+# [label] or [url] after the alt text
+LABEL_REGEX = re.compile(r"\[([^\[\]\n]{0,%d})\]" % MAX_URL_LENGTH)
+# src attribute of an <img> tag, up to the quote of its value, and its value
+SRC_ATTRIBUTE_REGEX = re.compile(r"""\bsrc[ \t\n]*=[ \t\n]*(?=["'])""", re.IGNORECASE)
+SRC_VALUE_REGEX = re.compile(r""""(?P<double>[^"]{0,%d})"|'(?P<single>[^']{0,%d})'""" % ((MAX_URL_LENGTH,) * 2))
+# "[label]: url" reference definitions, one line each
+DEFINITION_REGEX = re.compile(
+    r"^ {0,3}\[([^\[\]\n]{1,%d})\]:[ \t]*<?(https?://[^\s>]{1,%d})" % (MAX_ALT_LENGTH, MAX_URL_LENGTH),
+    re.IGNORECASE | re.MULTILINE)
+HTTP_REGEX = re.compile(r"https?://", re.IGNORECASE)
+
+
+def normalize_label(label: str) -> str:
+    return " ".join(label.split()).lower()
+
+
+def url_end(url: str) -> str:
+    """The last part of the url, after its last "/", from which the local name of the image is made"""
+    return url[url.rfind("/") + 1:]
+
+
+class TextFinder:
+    """
+    Searches of a text at increasing starts, each part of the text is only searched once per string or pattern,
+    however many triggers look at it.
+    """
+
+    def __init__(self, text: str) -> None:
+        self.text = text
+        self.next_found = {}  # string -> index of its next occurrence in text, -1 if there is none
+        self.next_match = {}  # pattern -> its next match in text, None if there is none
+        self.last_match = {}  # pattern -> (index, match) of its last match attempt
+
+    def find(self, sub: str, start: int) -> int:
+        """text.find(sub, start) for increasing starts"""
+        found = self.next_found.get(sub)
+        if found is None or -1 < found < start:
+            found = self.next_found[sub] = self.text.find(sub, start)
+        return found
+
+    def search(self, pattern: Pattern, start: int):
+        """pattern.search(text, start) for increasing starts"""
+        if pattern not in self.next_match or self.next_match[pattern] is not None and \
+                self.next_match[pattern].start() < start:
+            self.next_match[pattern] = pattern.search(self.text, start)
+        return self.next_match[pattern]
+
+    def match(self, pattern: Pattern, index: int):
+        """pattern.match(text, index) for increasing indexes, computed once per index"""
+        last = self.last_match.get(pattern)
+        if last is None or last[0] != index:
+            last = self.last_match[pattern] = (index, pattern.match(self.text, index))
+        return last[1]
+
+    def img_src(self, start: int, value_pattern: Pattern = SRC_VALUE_REGEX):
+        """
+        The match of value_pattern on the value of the first src attribute of the <img tag at start that it matches,
+        or None. The attribute must start within MAX_URL_LENGTH characters of the tag and before its first ">".
+        The src attributes of the text are only searched once, so that many unclosed tags do not make
+        each trigger scan MAX_URL_LENGTH characters.
+        """
+        tag_end = self.find(">", start)
+        window_end = start + len("<img") + MAX_URL_LENGTH  # the last start of the src attribute
+        attribute = self.search(SRC_ATTRIBUTE_REGEX, start + len("<img"))
+        while attribute is not None and attribute.start() <= window_end and \
+                (tag_end == -1 or attribute.end() < tag_end):
+            value = self.match(value_pattern, attribute.end())
+            if value is not None:
+                return value
+            attribute = self.search(SRC_ATTRIBUTE_REGEX, attribute.start() + 1)
+        return None
+
+
+def scan_image_links(text: str, stop: int = None, references: bool = True) -> List[Tuple[int, int, str, str]]:
+    """
+    Find the image links of a markdown text in one pass, without backtracking: inline images ![alt](url "title"),
+    images with the url between brackets ![alt][url], reference-style images ![alt][label] / ![label][] / ![label]
+    (the url of their "[label]: url" definition is returned), and <img src="url"> tags.
+    Only http(s) urls are returned, sorted by position, as the (start, end, url, end) tuples of find_url_spans,
+    where start:end is the span of the url in text. The end of a link is the part of the url after its last "/",
+    the end of an <img> tag is the last 4 characters of the url, as the regexes of localize.py did.
+    The work done for each construct is bounded by MAX_ALT_LENGTH and MAX_URL_LENGTH, so that the time is linear
+    in the length of text.
+    If stop is given, only the links starting before stop are returned (they may end after it).
+    If references is False, reference-style images are not resolved, e.g. when text is only a part of a file.
+    """
+    url_spans = []
+    finder = TextFinder(text)
+    definitions = None  # label -> span of its url, parsed on the first reference
+    referenced = set()
+
+    def add_reference(label: str) -> bool:
+        """Add the url of the definition of label, return False if label is not defined"""
+        nonlocal definitions
+        if not references:
+            return False
+        if definitions is None:
+            definitions = {}
+            for d in DEFINITION_REGEX.finditer(text):
+                definitions.setdefault(normalize_label(d.group(1)), d.span(2))
+        span = definitions.get(normalize_label(label))
+        if span is None:
+            return False
+        if span not in referenced:
+            referenced.add(span)
+            url = text[span[0]:span[1]]
+            url_spans.append((span[0], span[1], url, url_end(url)))
+        return True
+
+    def find_alt_end(start: int, subs: Tuple[str, ...]) -> int:
+        """Index of the first of subs after start, on the same line and within MAX_ALT_LENGTH, else -1"""
+        line_end = finder.find("\n", start)
+        stop = min(len(text) if line_end == -1 else line_end, start + MAX_ALT_LENGTH)
+        found = [index for index in (finder.find(sub, start) for sub in subs) if -1 < index < stop]
+        return min(found) if found else -1
+
+    pos = 0  # end of the last link found, the triggers inside it are skipped
+    for trigger in TRIGGER_REGEX.finditer(text):
+        start = trigger.start()
+        if stop is not None and start >= stop:
+            break
+        if start < pos:
+            continue
+        if text[start] == "<":
+            m = finder.img_src(start)
+            if m is not None:
+                group = "double" if m.group("double") is not None else "single"
+                if HTTP_REGEX.match(m.group(group)):
+                    url_spans.append((m.start(group), m.end(group), m.group(group), m.group(group)[-4:]))
+                    pos = m.end()
+            continue
+        # alt text up to the first "]" of the line: ![alt]
+        alt_end = find_alt_end(trigger.end(), ("]",))
+        if alt_end != -1 and text.startswith(("(", "["), alt_end + 1):
+            after = alt_end + 1
+        else:
+            # ![label] shortcut reference
+            if alt_end != -1 and add_reference(text[trigger.end():alt_end]):
+                continue
+            # else an alt text containing brackets, up to the first "](" or "][" of the line
+            alt_end = find_alt_end(trigger.end(), ("](", "]["))
+            if alt_end == -1:
+                continue
+            after = alt_end + 1
+        if text.startswith("(", after):
+            m = finder.match(DESTINATION_REGEX, after)
+            if m is not None:
+                group = "bracketed" if m.group("bracketed") is not None else "url"
+                if HTTP_REGEX.match(m.group(group)):
+                    url_spans.append((m.start(group), m.end(group), m.group(group), url_end(m.group(group))))
+                    pos = m.end()
+            continue
+        m = finder.match(LABEL_REGEX, after)
+        if m is None:
+            continue
+        if HTTP_REGEX.match(m.group(1)):
+            # ![alt][url]
+            url_spans.append((m.start(1), m.end(1), m.group(1), url_end(m.group(1))))
+            pos = m.end()
+        else:
+            # ![alt][label], or ![label][]
+            add_reference(m.group(1) or text[trigger.end():after - 1])
+    url_spans.sort()
+    return url_spans
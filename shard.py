@@ -0,0 +1,91 @@
+# shard.py
+import argparse
+import hashlib
+import json
+import os
+from typing import Dict, List, Optional, Tuple
+
+PLAN_FOLDER_NAME = ".plan"
+PLAN_NAME = "plan.json"
+
+
+def parse_shard(value: str) -> Tuple[int, int]:
+    """Parse a "k/N" shard argument, the k-th of N shards (1 <= k <= N)"""
+    try:
+        k, n = (int(part) for part in value.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected k/N such as 1/4")
+    if not 1 <= k <= n:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, k must be between 1 and N")
+    return k, n
+
+
+def shard_of(url: str, shards: int) -> int:
+    """The shard (1 to shards) of url, by its hash, the same in every process and on every machine"""
+    return int(hashlib.sha256(url.encode("utf-8")).hexdigest()[:8], 16) % shards + 1
+
+
+def shard_path(plan_dir: str, k: int, shards: int) -> str:
+    return os.path.join(plan_dir, f"shard-{k}-of-{shards}.json")
+
+
+def result_path(plan_dir: str, k: int, shards: int) -> str:
+    return os.path.join(plan_dir, f"result-{k}-of-{shards}.json")
+
+
+def write_json(path: str, data: Dict) -> None:
+    """Write data to path atomically, so that a reader never sees a partial file"""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path: str) -> Optional[Dict]:
+    """Return the content of the JSON file path, None if it does not exist"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def write_plan(plan_dir: str, img_dict: Dict[str, List[str]], shards: int,
+               validators: Dict[str, Tuple] = None) -> List[int]:
+    """
+    Split img_dict (url -> image paths, relative to the root folder) into shards by url hash, and write every shard
+    with the saved validators of its urls to plan_dir, removing the shards and results of a previous plan.
+    Return the number of urls of each shard.
+    """
+    os.makedirs(plan_dir, exist_ok=True)
+    for name in os.listdir(plan_dir):
+        if name.startswith(("shard-", "result-", "failed")):
+            os.remove(os.path.join(plan_dir, name))
+    shard_dicts = [{} for _ in range(shards)]
+    for url, paths in img_dict.items():
+        shard_dicts[shard_of(url, shards) - 1][url] = {"paths": paths,
+                                                       "validators": (validators or {}).get(url)}
+    for k, shard_dict in enumerate(shard_dicts, 1):
+        write_json(shard_path(plan_dir, k, shards), {"shard": k, "shards": shards, "urls": shard_dict})
+    write_json(os.path.join(plan_dir, PLAN_NAME), {"shards": shards, "urls": len(img_dict)})
+    return [len(shard_dict) for shard_dict in shard_dicts]
+
+
+class ShardCache:
+    """
+    Validators (ETag, Last-Modified, Content-Length) of the urls of one shard, in memory: the cache of download()
+    in a shard process, instead of the manifest, which is only written by the merge.
+    """
+
+    def __init__(self, validators: Dict[str, Tuple] = None) -> None:
+        self.validators = dict(validators or {})
+
+    def get_validators(self, url: str) -> Optional[Tuple[Optional[str], Optional[str], Optional[int]]]:
+        validators = self.validators.get(url)
+        return tuple(validators) if validators else None
+
+    def set_validators(self, url: str, etag: Optional[str], last_modified: Optional[str],
+                       content_length: Optional[int]) -> None:
+        self.validators[url] = (etag, last_modified, content_length)
+
+    def commit(self) -> None:
+        pass
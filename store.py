@@ -0,0 +1,54 @@
+# store.py
+import hashlib
+import logging
+import os
+
+from utils import link_file
+
+STORE_FOLDER_NAME = ".img_store"
+
+
+class AssetStore:
+    """
+    Content-addressed image store: every distinct image is kept once under folder, named by its sha256,
+    and the paths in the .assets folders are hardlinks (or reflinks / copies) to it.
+    """
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        # the shards of a plan open the same store at the same time (see md_execute)
+        os.makedirs(self.folder, exist_ok=True)
+        self.links = {"hardlink": 0, "reflink": 0, "copy": 0}
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.folder, digest[:2], digest)
+
+    def part_path(self, url: str) -> str:
+        """
+        Return the path in the store where the download of url is written before it is added,
+        the same for every run so that an interrupted download can be resumed.
+        """
+        return os.path.join(self.folder, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".part")
+
+    def add_file(self, tmp_path: str, digest: str) -> str:
+        """
+        Move the downloaded file tmp_path, whose sha256 is digest, in the store if it is not there yet,
+        and return the path of its blob.
+        """
+        blob_path = self.blob_path(digest)
+        if not os.path.exists(blob_path):
+            # several processes may add blobs at the same time (see md_execute)
+            os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+            os.replace(tmp_path, blob_path)
+        else:
+            os.remove(tmp_path)
+            logging.info(f"Already stored: {digest}")
+        return blob_path
+
+    def link(self, blob_path: str, img_path: str) -> None:
+        """
+        Fan the blob out to img_path.
+        """
+        method = link_file(blob_path, img_path)
+        self.links[method] += 1
+        logging.info(f"Linked ({method}): {img_path}")
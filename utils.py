@@ -1,7 +1,8 @@
 # utils.py
 import os
 import shutil
-import requests
+
+FICLONE = 0x40049409  # linux ioctl to share the extents of two files (reflink)
 
 def create_folder(folder: str) -> None:
     """
@@ -20,21 +21,31 @@ def delete_folder(folder):
         shutil.rmtree(folder)
 
 
-def is_valid_url(url: str) -> bool:
+def link_file(src: str, dst: str) -> str:
     """
-    Check the validity of a URL.
+    Make dst point to the same content as src, as cheap as the filesystem allows.
 
     Parameters:
-    - url (str): The URL to be checked.
+    - src (str): The path of the existing file.
+    - dst (str): The path of the file to be created.
 
     Returns:
-    - bool: True if the URL is valid; False otherwise.
+    - str: The method used, one of "hardlink", "reflink" or "copy".
     """
     try:
-        response = requests.head(url)
-        return response.status_code == 200
-    except requests.RequestException:
-        return False
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        import fcntl
+        with open(src, "rb") as src_file, open(dst, "wb") as dst_file:
+            fcntl.ioctl(dst_file.fileno(), FICLONE, src_file.fileno())
+        return "reflink"
+    except (ImportError, OSError):
+        pass
+    shutil.copyfile(src, dst)
+    return "copy"
 
 
 def write_file(folder_path: str, file_name: str, file_data: str) -> None:
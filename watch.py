@@ -0,0 +1,213 @@
+# watch.py
+import asyncio
+import ctypes
+import ctypes.util
+import logging
+import os
+import struct
+import sys
+from typing import AsyncIterator, Callable, Dict, Iterator, Optional, Set, Tuple
+
+from shard import PLAN_FOLDER_NAME
+from store import STORE_FOLDER_NAME
+
+DEBOUNCE = 1.0  # seconds without changes before the changed files are processed
+POLL_INTERVAL = 2.0  # seconds between two scans of the tree when inotify is not available
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len, followed by the name
+
+
+def is_source_folder(name: str) -> bool:
+    """Whether a folder of this name may contain source markdown files (and not the outputs of the localization)"""
+    return name.strip() != 'out' and name not in (STORE_FOLDER_NAME, PLAN_FOLDER_NAME) and not name.endswith('.assets')
+
+
+def source_folders(root_path: str) -> Iterator[Tuple[str, list]]:
+    """Walk the folders under root_path which may contain source markdown files, yield (folder, file names)"""
+    for cur_path, dirs, files in os.walk(root_path):
+        dirs[:] = [d for d in dirs if is_source_folder(d)]
+        yield cur_path, files
+
+
+class PollingDetector:
+    """
+    Find the markdown files created or modified under root_path by comparing their mtime and size
+    with those of the previous scan, every interval seconds. Only the directory entries are read.
+    """
+
+    def __init__(self, root_path: str, on_change: Callable[[Optional[str]], None],
+                 interval: float = POLL_INTERVAL) -> None:
+        self.root_path = root_path
+        self.on_change = on_change
+        self.interval = interval
+        self.stats = self.scan()
+
+    def scan(self) -> Dict[str, Tuple[int, int]]:
+        stats = {}
+        for cur_path, _ in source_folders(self.root_path):
+            try:
+                with os.scandir(cur_path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(".md") and entry.is_file():
+                            stat = entry.stat()
+                            stats[entry.path] = (stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                continue  # removed while scanning
+        return stats
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            stats = await loop.run_in_executor(None, self.scan)
+            for path, stat in stats.items():
+                if self.stats.get(path) != stat:
+                    self.on_change(path)
+            self.stats = stats
+
+    def close(self) -> None:
+        pass
+
+
+class InotifyDetector:
+    """
+    Find the markdown files written or moved under root_path with inotify (Linux), through ctypes.
+    Every source folder is watched, new folders are watched as they are created.
+    Raise OSError if inotify is not available or the folders can not all be watched.
+    """
+
+    def __init__(self, root_path: str, on_change: Callable[[Optional[str]], None]) -> None:
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        self.on_change = on_change
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}  # watch descriptor -> folder
+        try:
+            for cur_path, _ in source_folders(root_path):
+                self.add_watch(cur_path)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_watch(self, folder: str) -> None:
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(folder), WATCH_MASK)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, f"inotify_add_watch failed on {folder}: {os.strerror(errno)}")
+        self.watches[wd] = folder
+
+    async def run(self) -> None:
+        loop = asyncio.get_event_loop()
+        loop.add_reader(self.fd, self.read_events)
+        try:
+            await loop.create_future()  # the events are read by read_events until cancelled
+        finally:
+            loop.remove_reader(self.fd)
+
+    def read_events(self) -> None:
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = os.fsdecode(data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0"))
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                logging.warning("Too many changes at once, rescanning all files")
+                self.on_change(None)
+                continue
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            folder = self.watches.get(wd)
+            if folder is None:
+                continue
+            path = os.path.join(folder, name)
+            if mask & IN_ISDIR:
+                if is_source_folder(name):
+                    self.add_folder(path)
+            elif name.endswith(".md") and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                self.on_change(path)
+
+    def add_folder(self, folder: str) -> None:
+        """Watch a new folder and its subfolders, and report the markdown files already in them"""
+        for cur_path, files in source_folders(folder):
+            try:
+                self.add_watch(cur_path)
+            except OSError as e:
+                logging.warning(f"{e}, its changes will be missed")
+            for filename in files:
+                if filename.endswith(".md"):
+                    self.on_change(os.path.join(cur_path, filename))
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class ChangeWatcher:
+    """
+    Watch the markdown files under root_path with inotify where available, else by polling every poll_interval
+    seconds, and yield the sets of files changed, once no file changed for debounce seconds.
+    """
+
+    def __init__(self, root_path: str, debounce: float = DEBOUNCE, poll_interval: float = POLL_INTERVAL,
+                 poll: bool = False) -> None:
+        self.root_path = root_path
+        self.debounce = debounce
+        self.pending = set()
+        self.changed = None
+        self.detector = None
+        if not poll:
+            try:
+                self.detector = InotifyDetector(root_path, self.add_change)
+                logging.warning(f"Watching {root_path} with inotify...")
+            except (OSError, AttributeError) as e:
+                logging.warning(f"inotify not available ({e}), polling instead")
+        if self.detector is None:
+            self.detector = PollingDetector(root_path, self.add_change, poll_interval)
+            logging.warning(f"Watching {root_path} every {poll_interval}s...")
+
+    def add_change(self, path: Optional[str]) -> None:
+        """Record a changed markdown file, or all of them if path is None"""
+        if path is None:
+            self.pending.update(os.path.join(cur_path, filename) for cur_path, files in source_folders(self.root_path)
+                                for filename in files if filename.endswith(".md"))
+        else:
+            self.pending.add(path)
+        self.changed.set()
+
+    async def batches(self) -> AsyncIterator[Set[str]]:
+        self.changed = asyncio.Event()
+        detector_task = asyncio.ensure_future(self.detector.run())
+        try:
+            while True:
+                await self.changed.wait()
+                # wait until the files stopped changing, e.g. an editor saving several times
+                while True:
+                    self.changed.clear()
+                    try:
+                        await asyncio.wait_for(self.changed.wait(), self.debounce)
+                    except asyncio.TimeoutError:
+                        break
+                batch, self.pending = self.pending, set()
+                yield batch
+        finally:
+            detector_task.cancel()
+            try:
+                await detector_task
+            except asyncio.CancelledError:
+                pass
+            self.detector.close()